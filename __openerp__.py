@@ -13,6 +13,7 @@
             ],
     'data': [
 	    'wiki_view.xaml',
+	    'wiki_data.xaml',
 	    'security/ir.model.access.csv',
             ],
     'css':[
@@ -1,19 +1,38 @@
 # -*- coding: utf-8 -*-
 
+import json
 import logging
 import os
+import threading
 import werkzeug
-from base64 import b64decode
+from Queue import Empty, Full, Queue
+from time import time
+from openerp import SUPERUSER_ID
+from openerp.exceptions import ERPError
 from openerp.addons.web.http import Controller, httprequest
 from openerp.addons.web.controllers.main import content_disposition
+from openerp.modules.registry import RegistryManager
 from mimetypes import guess_type
 from scription import OrmFile
+from werkzeug.http import http_date
+from werkzeug.wrappers import Response
+from werkzeug.wsgi import wrap_file
+
+from wiki import (
+        ENCODINGS, IMAGE_WIDTH, WIKI_PATH, blob_store, image_path, is_sibling, key_directory, make_rendition,
+        name_key, precompressed, profiled, rendition_width, stats_report, wiki_config, wiki_doc, wiki_stats,
+        )
 
 CONFIG = '/%s/config/fnx.ini' % os.environ['VIRTUAL_ENV']
-settings = OrmFile(CONFIG).openerp
-db = settings.db
-login = settings.user
-password = settings.pw
+
+# where `Wiki.files` serves the on-disk mirror
+FILES_URL = '/wiki/files'
+
+ARCHIVE_TYPES = {
+        'zip': 'application/zip',
+        'tar': 'application/x-tar',
+        'tgz': 'application/gzip',
+        }
 
 _logger = logging.getLogger(__name__)
 
@@ -23,29 +42,547 @@ class Wiki(Controller):
     _cp_path = '/wiki'
 
     @httprequest
-    def image(self, request, model, img_id, **kw):
-        session = request.session
-        session._db = db
-        session._login = login
-        session._uid = 1
-        session._password = password
-        img_id = int(img_id)
-        Model = request.session.model(model)
-        page = Model.read([img_id], ['name', 'wiki_img'], request.context)[0] 
-        image_name = page['name']
-        image = b64decode(page['wiki_img'])
+    def image(self, request, model, img_id, size=None, wiki_profile=None, **kw):
+        if wiki_profile and is_admin(request, service.db):
+            return profiled('/wiki/image', self._image, request, model, img_id, size)
+        with wiki_stats.operation('image.request', model=model, id=img_id, size=size):
+            return self._image(request, model, img_id, size)
+
+    def _image(self, request, model, img_id, size):
         try:
-            return request.make_response(
-                    image,
-                    headers=[
+            img_id = int(img_id)
+            width = rendition_width(int(size)) if size else IMAGE_WIDTH
+        except ValueError:
+            return werkzeug.exceptions.NotFound()
+        db = service.db
+        # validators first -- a revalidation never touches the image itself
+        page = image_index.get(db, model, img_id, width)
+        if page is None:
+            page = service.page(db, model, img_id)
+            if page is None:
+                return werkzeug.exceptions.NotFound()
+            if page['img_state'] == 'pending':
+                # still being processed -- send the source, and do not let it be cached
+                image = service.image(db, model, img_id, 'source_img')
+                if image is None:
+                    return werkzeug.exceptions.NotFound()
+                return request.make_response(image, headers=[
+                        ('Content-Disposition',  content_disposition(page['name'], request)),
+                        ('Content-Type', guess_type(page['name'])[0] or 'octet-stream'),
+                        ('Content-Length', len(image)),
+                        ('Cache-Control', 'no-cache'),
+                        ])
+            if width != IMAGE_WIDTH:
+                with wiki_stats.phase('image.rendition'):
+                    self._ensure_rendition(db, model, img_id, page, width)
+            page = image_index.set(db, model, img_id, page, width)
+        image_name = page['name']
+        headers = validators(page)
+        if page['etag'] and request.httprequest.if_none_match.contains(page['etag']):
+            return not_modified(request, headers)
+        if page['file'] is not None:
+            try:
+                headers.extend([
                         ('Content-Disposition',  content_disposition(image_name, request)),
                         ('Content-Type', guess_type(image_name)[0] or 'octet-stream'),
-                        ('Content-Length', len(image)),
-                        ],
-                    )
+                        ])
+                return file_response(request, page['file'], headers, page['etag'])
+            except (IOError, OSError):
+                # gone since it was indexed; fall back to the database
+                _logger.warning('unable to serve %r from disk', page['file'])
+                image_index.discard(db, model, img_id, width)
+                headers = validators(page)
+        image = service.image(db, model, img_id)
+        if image is None:
+            return werkzeug.exceptions.NotFound()
+        try:
+            headers.extend([
+                    ('Content-Disposition',  content_disposition(image_name, request)),
+                    ('Content-Type', guess_type(image_name)[0] or 'octet-stream'),
+                    ])
+            return ranged_response(request, image, headers, page['etag'])
         except Exception:
             _logger.exception('error accessing %r [%r]', image_name, img_id)
             return werkzeug.exceptions.InternalServerError(
                     'An error occured attempting to access %r; please let IT know.' % image_name
                     )
 
+    def _ensure_rendition(self, db, model, img_id, page, width):
+        """
+        create the `width` rendition of `page` if it does not exist yet
+        """
+        if image_path(WIKI_PATH, page['wiki_key'], page['name_key'], width).exists():
+            return
+        data = None
+        if not image_path(WIKI_PATH, page['wiki_key'], page['name_key']).exists():
+            data = service.image(db, model, img_id, 'source_img')
+        try:
+            make_rendition(WIKI_PATH, page['wiki_key'], page['name_key'], page['name'], width, data)
+        except Exception:
+            # serve the wiki-sized image instead
+            _logger.exception('unable to create %dpx rendition of %r', width, page['name'])
+
+    @httprequest
+    def page(self, request, key, name, **kw):
+        """
+        redirect to the rendered page `name` of wiki `key` under /wiki/files
+        """
+        try:
+            key_directory(WIKI_PATH, key)
+        except ValueError:
+            return werkzeug.exceptions.NotFound()
+        page_key = name_key(name)
+        if page_key.endswith('.html'):
+            page_key = page_key[:-5]
+        if not page_key or page_key.startswith('.'):
+            return werkzeug.exceptions.NotFound()
+        return werkzeug.utils.redirect('%s/%s/%s.html' % (FILES_URL, name_key(key), page_key))
+
+    @httprequest
+    def files(self, request, **kw):
+        """
+        the on-disk mirror as /wiki/files/<key>/<file> -- pages, images, and stylesheets,
+        straight from disk rather than from the database
+
+        as for `export`, the session must be logged in as a user who can read the
+        wiki model the key belongs to
+
+        the relative links between the files resolve just as they do on disk, and
+        pages and stylesheets are sent precompressed if the browser accepts it
+        """
+        path = request.httprequest.path
+        with wiki_stats.operation('files.request', path=path):
+            return self._files(request, path[len(FILES_URL)+1:].split('/'))
+
+    def _files(self, request, parts):
+        # /wiki/files/... is routed here as the nearest exposed method; only accept
+        # <key>/<file>, both already in name_key form
+        if len(parts) != 2 or any(not p or p.startswith('.') or p != name_key(p) for p in parts):
+            return werkzeug.exceptions.NotFound()
+        directory, name = parts
+        db = service.db
+        uid = session_uid(request, db)
+        if uid is None:
+            return werkzeug.exceptions.Forbidden('wiki: log in to read the wiki')
+        model = key_model(db, directory)
+        if model is None:
+            return werkzeug.exceptions.NotFound()
+        with service.cursor(db) as cr:
+            if not RegistryManager.get(db)[model].check_access_rights(cr, uid, 'read', raise_exception=False):
+                return werkzeug.exceptions.Forbidden()
+        file = WIKI_PATH/directory/name
+        if is_sibling(name) or not os.path.isfile(file):
+            return werkzeug.exceptions.NotFound()
+        if precompressed(file):
+            found = page_variant(request, file)
+        else:
+            found = file, None, os.stat(file)
+        if found is None:
+            return werkzeug.exceptions.NotFound()
+        file, encoding, stat = found
+        etag = '%x-%x' % (int(stat.st_mtime * 1000000), stat.st_size)
+        if encoding:
+            etag = '%s-%s' % (etag, encoding)
+        headers = [
+                ('Cache-Control', 'max-age=%d' % wiki_config('page_max_age', 60)),
+                ('ETag', '"%s"' % etag),
+                ('Last-Modified', http_date(stat.st_mtime)),
+                ]
+        if precompressed(name):
+            headers.append(('Vary', 'Accept-Encoding'))
+        if request.httprequest.if_none_match.contains(etag):
+            return not_modified(request, headers)
+        content_type = guess_type(name)[0] or 'application/octet-stream'
+        if content_type.startswith('text/'):
+            content_type += '; charset=utf-8'
+        headers.append(('Content-Type', content_type))
+        if encoding:
+            headers.append(('Content-Encoding', encoding))
+        try:
+            return file_response(request, file, headers, etag)
+        except (IOError, OSError):
+            # removed or renamed since it was found
+            return werkzeug.exceptions.NotFound()
+
+    @httprequest
+    def export(self, request, key, model='wiki.page', format='zip', since=None, **kw):
+        """
+        the on-disk mirror of wiki `key` as a zip (or tar, or tgz) archive
+
+        `since` is the manifest.json of an earlier export, to get only what changed
+        """
+        if format not in ARCHIVE_TYPES:
+            return werkzeug.exceptions.BadRequest('unknown archive format: %r' % format)
+        if since:
+            try:
+                since = json.loads(since)
+            except ValueError:
+                since = None
+            since = manifest_files(since)
+            if since is None:
+                return werkzeug.exceptions.BadRequest('since: not a manifest')
+        db = service.db
+        if service._table(db, model) is None:
+            return werkzeug.exceptions.NotFound()
+        uid = session_uid(request, db)
+        if uid is None:
+            return werkzeug.exceptions.Forbidden('wiki: log in to export a wiki')
+        pages = RegistryManager.get(db)[model]
+        with service.cursor(db) as cr:
+            if not pages.check_access_rights(cr, uid, 'read', raise_exception=False):
+                return werkzeug.exceptions.Forbidden()
+            try:
+                # the page list is read here; the archive itself is built from disk
+                chunks = pages.export_site(cr, uid, key, format, since)
+            except ERPError:
+                return werkzeug.exceptions.NotFound()
+        filename = '%s.%s' % (name_key(key), format)
+        return Response(
+                chunks,
+                headers=[
+                    ('Content-Type', ARCHIVE_TYPES[format]),
+                    ('Content-Disposition', content_disposition(filename, request)),
+                    ],
+                direct_passthrough=True,
+                )
+
+    @httprequest
+    def stats(self, request, **kw):
+        if not is_admin(request, service.db):
+            return werkzeug.exceptions.Forbidden('wiki: statistics are for administrators')
+        return request.make_response(
+                json.dumps(stats_report(), sort_keys=True),
+                headers=[('Content-Type', 'application/json')],
+                )
+
+
+class WikiService(object):
+    """
+    direct database access for the wiki controller
+
+    each database keeps a pool of autocommit cursors, so a request costs one query
+    instead of a session setup and an RPC `read`; a model that is not a wiki, or a
+    record that is not an image, is None
+    """
+
+    def __init__(self, config_file, pool_size):
+        self.config_file = config_file
+        self.pool_size = pool_size
+        self.lock = threading.Lock()
+        self.cursors = {}
+        self._settings = None
+
+    @property
+    def settings(self):
+        if self._settings is None:
+            self._settings = OrmFile(self.config_file).openerp
+        return self._settings
+
+    @property
+    def db(self):
+        return self.settings.db
+
+    def record(self, phase, start):
+        "add the time since `start` to the statistics of `phase`"
+        wiki_stats.add('image.%s' % phase, time() - start)
+
+    def _table(self, db, model):
+        """
+        the table behind `model`, or None if it is not a wiki
+        """
+        Model = RegistryManager.get(db).get(model)
+        if Model is None or not (Model._name == 'wiki.page' or Model._name in wiki_doc._wiki_tables):
+            return None
+        return Model._table
+
+    def cursor(self, db):
+        """
+        context manager lending a pooled cursor for `db`
+        """
+        return _PooledCursor(self, db)
+
+    def _acquire(self, db):
+        with self.lock:
+            pool = self.cursors.setdefault(db, Queue(self.pool_size))
+        try:
+            return pool.get_nowait()
+        except Empty:
+            cr = RegistryManager.get(db).db.cursor()
+            cr.autocommit(True)
+            return cr
+
+    def _release(self, db, cr, broken=False):
+        if not broken:
+            try:
+                self.cursors[db].put_nowait(cr)
+                return
+            except Full:
+                pass
+        cr.close()
+
+    def page(self, db, model, id):
+        """
+        name, location, and validators of the image `id`, or None
+        """
+        start = time()
+        table = self._table(db, model)
+        if table is None:
+            return None
+        with self.cursor(db) as cr:
+            self.record('setup', start)
+            start = time()
+            cr.execute(
+                    "SELECT name, name_key, wiki_key, wiki_img_digest, img_state, write_date FROM %s"
+                    " WHERE id=%%s AND source_type='img'" % (table, ),
+                    (id, ),
+                    )
+            row = cr.dictfetchone()
+        self.record('query', start)
+        return row
+
+    def image(self, db, model, id, column='wiki_img'):
+        """
+        the wiki-sized (or, with `column='source_img'`, original) image `id`, from the
+        blob store, or None
+        """
+        start = time()
+        table = self._table(db, model)
+        if table is None:
+            return None
+        with self.cursor(db) as cr:
+            self.record('setup', start)
+            start = time()
+            cr.execute('SELECT %s_digest FROM %s WHERE id=%%s' % (column, table), (id, ))
+            row = cr.fetchone()
+        self.record('query', start)
+        return row and row[0] and blob_store.get(row[0]) or None
+
+
+class _PooledCursor(object):
+
+    def __init__(self, service, db):
+        self.service = service
+        self.db = db
+
+    def __enter__(self):
+        self.cr = self.service._acquire(self.db)
+        return self.cr
+
+    def __exit__(self, exc_type, exc, tb):
+        self.service._release(self.db, self.cr, broken=exc_type is not None)
+
+service = WikiService(CONFIG, wiki_config('service_cursors', 4))
+
+
+class ImageIndex(object):
+    """
+    (database, model, id, width) -> the image's on-disk file and validators
+
+    an entry is used only while its file is unchanged, so saving a new image (which
+    rewrites the file) or renaming one (which removes it) is noticed on the next request
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, db, model, id, width=IMAGE_WIDTH):
+        with self.lock:
+            entry = self.entries.get((db, model, id, width))
+        if entry is None or entry['file'] is None:
+            return None
+        try:
+            if os.stat(entry['file']).st_mtime != entry['mtime']:
+                return None
+        except OSError:
+            return None
+        return entry
+
+    def set(self, db, model, id, page, width=IMAGE_WIDTH):
+        """
+        add `page` (name, name_key, wiki_key, wiki_img_digest, write_date) to the index;
+        returns the entry, whose `file` is None if the image is not on disk
+        """
+        entry = dict(page, file=None, mtime=None, etag=page['wiki_img_digest'])
+        if entry['etag'] and width != IMAGE_WIDTH:
+            entry['etag'] = '%s-%d' % (entry['etag'], width)
+        file = image_path(WIKI_PATH, page['wiki_key'], page['name_key'], width)
+        try:
+            entry['mtime'] = os.stat(file).st_mtime
+            entry['file'] = file
+        except OSError:
+            pass
+        with self.lock:
+            self.entries[db, model, id, width] = entry
+        return entry
+
+    def discard(self, db, model, id, width=IMAGE_WIDTH):
+        with self.lock:
+            self.entries.pop((db, model, id, width), None)
+
+image_index = ImageIndex()
+
+
+def session_uid(request, db):
+    """
+    the uid logged in to `db` in the web session of `request`, or None
+    """
+    session = getattr(request, 'session', None)
+    if session is None or not getattr(session, '_uid', None) or session._db != db:
+        return None
+    return session._uid
+
+def key_model(db, directory):
+    """
+    the wiki model whose pages are kept in the on-disk `directory`, or None
+
+    public keys belong to wiki.page, and private ones to the wiki model that has
+    the key as its default
+    """
+    registry = RegistryManager.get(db)
+    with service.cursor(db) as cr:
+        cr.execute('SELECT name, private FROM %s' % (registry['wiki.key']._table, ))
+        keys = cr.fetchall()
+    for name, private in keys:
+        if name_key(name) != directory:
+            continue
+        if not private:
+            return 'wiki.page'
+        for model in sorted(wiki_doc._wiki_tables):
+            Model = registry.get(model)
+            if Model is not None and Model._defaults.get('wiki_key') == name:
+                return model
+    return None
+
+def is_admin(request, db):
+    """
+    True if the web session of `request` is logged in to `db` as an administrator
+    """
+    uid = session_uid(request, db)
+    if uid is None:
+        return False
+    if uid == SUPERUSER_ID:
+        return True
+    with service.cursor(db) as cr:
+        return RegistryManager.get(db)['res.users'].has_group(cr, uid, 'base.group_system')
+
+def validators(page):
+    """
+    ETag, Last-Modified, and Cache-Control headers for `page`
+    """
+    headers = [
+            ('Cache-Control', 'max-age=%d' % wiki_config('image_max_age', 3600)),
+            ('Accept-Ranges', 'bytes'),
+            ]
+    if page['etag']:
+        headers.append(('ETag', '"%s"' % page['etag']))
+    if page['write_date']:
+        headers.append(('Last-Modified', http_date(page['write_date'])))
+    return headers
+
+def page_variant(request, file):
+    """
+    (file, content encoding, stat) of the best version of `file` for `request`: a
+    precompressed sibling the browser accepts, or else `file` itself; None if
+    `file` does not exist
+
+    a sibling older than `file` (still being written) is passed over
+    """
+    try:
+        stat = os.stat(file)
+    except OSError:
+        return None
+    accepted = request.httprequest.accept_encodings
+    for encoding, suffix, _ in ENCODINGS:
+        if not accepted[encoding]:
+            continue
+        try:
+            sibling = os.stat(file + suffix)
+        except OSError:
+            continue
+        if sibling.st_mtime >= stat.st_mtime:
+            return file + suffix, encoding, sibling
+    return file, None, stat
+
+def manifest_files(manifest):
+    """
+    the name -> digest map of an export's manifest (or of the map itself), or
+    None if `manifest` is not one
+    """
+    if isinstance(manifest, dict) and 'files' in manifest:
+        manifest = manifest['files']
+    if not isinstance(manifest, dict):
+        return None
+    for name, digest in manifest.items():
+        if not (isinstance(name, basestring) and isinstance(digest, basestring)):
+            return None
+    return manifest
+
+def not_modified(request, headers):
+    response = request.make_response('', headers=headers)
+    response.status_code = 304
+    return response
+
+def file_response(request, file, headers, etag):
+    """
+    serve `file` without reading it into memory
+
+    depending on the `wiki_sendfile` option the file is handed to the WSGI server's
+    file wrapper (which can use sendfile), or left to a fronting proxy through an
+    X-Sendfile or X-Accel-Redirect header
+    """
+    mode = wiki_config('sendfile', '').lower()
+    size = os.stat(file).st_size
+    if mode == 'x-sendfile':
+        return Response('', headers=headers + [('X-Sendfile', str(file))])
+    elif mode == 'x-accel-redirect':
+        prefix = wiki_config('accel_prefix', '/wiki-files/')
+        location = prefix.rstrip('/') + '/' + os.path.relpath(file, WIKI_PATH)
+        return Response('', headers=headers + [('X-Accel-Redirect', location)])
+    if request.httprequest.range is not None:
+        with open(file, 'rb') as fh:
+            return ranged_response(request, fh, headers, etag, length=size)
+    fh = open(file, 'rb')
+    return Response(
+            wrap_file(request.httprequest.environ, fh),
+            headers=headers + [('Content-Length', size)],
+            direct_passthrough=True,
+            )
+
+def ranged_response(request, data, headers, etag, length=None):
+    """
+    `data` as a full (200) or partial (206) response, depending on the Range and
+    If-Range headers of `request`
+
+    `data` is either a string, or a file of `length` bytes of which only the
+    requested range is read
+    """
+    httprequest = request.httprequest
+    if length is None:
+        length = len(data)
+    requested = httprequest.range
+    if_range = httprequest.headers.get('If-Range')
+    if requested is not None and (not if_range or if_range.strip('"') == etag):
+        byte_range = requested.range_for_length(length)
+        if byte_range is None:
+            response = request.make_response('', headers=headers + [('Content-Range', 'bytes */%d' % length)])
+            response.status_code = 416
+            return response
+        start, stop = byte_range
+        if hasattr(data, 'read'):
+            data.seek(start)
+            part = data.read(stop - start)
+        else:
+            part = data[start:stop]
+        response = request.make_response(
+                part,
+                headers=headers + [
+                    ('Content-Range', 'bytes %d-%d/%d' % (start, stop - 1, length)),
+                    ('Content-Length', stop - start),
+                    ],
+                )
+        response.status_code = 206
+        return response
+    if hasattr(data, 'read'):
+        data = data.read()
+    return request.make_response(data, headers=headers + [('Content-Length', length)])
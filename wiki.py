@@ -100,24 +100,101 @@ example `_view.xaml` file
             @context: {'search_default_type_top_level':'1', 'search_default_type_document':'1', 'search_default_type_not_empty':'1'}
 
             ~menuitem @Wiki #menu_some_wiki parent='<some_wiki_parent>' action='action_some_wiki' sequence='40'
+
+
+server options
+--------------
+
+set in the `[options]` section of the server config file:
+
+- `wiki_render_workers`: worker processes used when many pages need to be
+  regenerated at startup (default: 0 -- render in the server process); not
+  used with `wiki_regenerate_background`
+- `wiki_render_batch`: pages fetched, rendered, and written per batch during
+  parallel regeneration (default: 200)
+- `wiki_render_timeout`: seconds to wait for the workers to render a batch
+  before giving up on them and rendering the rest in the server process
+  (default: 600)
+- `wiki_render_cache_size`: rendered documents kept in memory (default: 1000)
+- `wiki_render_cache_disk`: also keep rendered documents under `WIKI_PATH/.cache`
+  so they are shared between processes (default: False)
+- `wiki_render_cache_disk_size`: rendered documents kept on disk (default: 50000)
+- `wiki_page_max_age`: seconds browsers may use a page, image, or stylesheet from
+  /wiki/files without revalidating it (default: 60)
+- `wiki_image_max_age`: seconds browsers may use an image from /wiki/image without
+  revalidating it (default: 3600)
+- `wiki_sendfile`: how /wiki/image and /wiki/files serve files from the on-disk
+  mirror -- empty to stream them through the WSGI server (default), `x-sendfile`
+  or `x-accel-redirect` to hand them to a fronting proxy
+- `wiki_accel_prefix`: the proxy location that maps to `WIKI_PATH` when using
+  `x-accel-redirect` (default: /wiki-files/)
+- `wiki_service_cursors`: idle database cursors the /wiki controller keeps per
+  database (default: 4)
+- `wiki_image_workers`: threads per database that resize saved images in the
+  background; 0 resizes them while saving (default: 2)
+- `wiki_image_sweep`: seconds between background checks for pending images
+  saved by other server processes (default: 60)
+- `wiki_image_max_bytes`: largest image, in bytes, that can be saved
+  (default: 50 MB)
+- `wiki_image_max_pixels`: largest image, in pixels, that can be saved or
+  resized (default: 50 million)
+- `wiki_search_config`: PostgreSQL text search configuration used for the
+  full-text index (default: english)
+- `wiki_image_widths`: widths of the image renditions offered through `srcset`
+  and /wiki/image?size= (default: 160, 480, 900, 1800); renditions other than
+  the 900 pixel `wiki_img` are created when first requested
+- `wiki_link_cache_age`: seconds a link-graph report is kept; reports are also
+  dropped by any change to links in this process (default: 300)
+- `wiki_gc_grace`: seconds an unreferenced stub page, placeholder image, or
+  image blob is kept before the scheduled sweep removes it (default: 604800)
+- `wiki_regenerate_background`: bring the on-disk files up to date in a
+  background thread once the registry has loaded, instead of while loading it;
+  either way only one server process at a time does so (default: False)
+- `wiki_slow_ms`: page saves and image requests taking at least this many
+  milliseconds log their phase timings at INFO instead of DEBUG (default: 500)
 """
 
 from antipathy import Path
 from base64 import b64decode, b64encode
+from binascii import a2b_base64
+import codecs
+from collections import OrderedDict
+from contextlib import contextmanager
+import cProfile
+from datetime import datetime
+import gzip
+from hashlib import sha1
 import io
+import json
 import logging
+import multiprocessing
 import openerp
 from openerp import VAR_DIR, SUPERUSER_ID
 from openerp.exceptions import ERPError
 from openerp.osv import osv, fields
-from openerp.tools import self_ids
+from openerp.osv.expression import NEGATIVE_TERM_OPERATORS
+from openerp.modules.registry import RegistryManager
+from openerp.tools import config, self_ids, DEFAULT_SERVER_DATETIME_FORMAT
+from openerp.tools.misc import human_size
 import os
 from PIL import Image, ImageOps
+import pstats
 import re
+import shutil
+import stonemark
+import tarfile
 from textwrap import dedent
-from stonemark import Document, escape, write_css, write_html as write_html_file
+from stonemark import Document, escape, write_css
 import threading
+import time
 from VSS.utils import translator
+import weakref
+import zipfile
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 _logger = logging.getLogger(__name__)
 
@@ -136,6 +213,1180 @@ def name_key(name):
     return name
 
 WIKI_PATH = Path(VAR_DIR) / 'wiki'
+BLOB_PATH = Path(VAR_DIR) / 'wiki-blobs'
+
+def key_directory(wiki_path, wiki_key):
+    """
+    on-disk directory of `wiki_key` under `wiki_path`
+
+    raises ValueError for a key whose directory would be hidden, or outside `wiki_path`
+    """
+    directory = name_key(wiki_key or '')
+    if not directory or directory.startswith('.') or '/' in directory or os.sep in directory:
+        raise ValueError('invalid wiki key: %r' % (wiki_key, ))
+    return wiki_path / directory
+
+# width of the `wiki_img` rendition
+IMAGE_WIDTH = 900
+
+# bump whenever the way pages are rendered or written to disk changes, so that
+# `_auto_init` knows to regenerate every page
+RENDER_VERSION = 4
+
+def renderer_version():
+    "version of the rendering pipeline -- this module plus stonemark"
+    stonemark_version = getattr(stonemark, 'version', None) or ()
+    return '%d/%s' % (RENDER_VERSION, '.'.join(str(v) for v in stonemark_version))
+
+def gzip_data(data):
+    "`data` gzipped -- with a fixed timestamp, so the same data always gives the same bytes"
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=9, mtime=0) as fh:
+        fh.write(data)
+    return buffer.getvalue()
+
+# (Content-Encoding, file suffix, compressor) of the precompressed siblings written
+# next to every page and stylesheet, in order of preference
+ENCODINGS = [('gzip', '.gz', gzip_data)]
+if brotli is not None:
+    ENCODINGS.insert(0, ('br', '.br', brotli.compress))
+
+def precompressed(file):
+    "True if `file` gets precompressed siblings in the on-disk mirror"
+    return file.endswith('.html') or os.path.basename(file) == 'stonemark.css'
+
+def is_sibling(file):
+    "True if `file` is the precompressed sibling of a page or stylesheet"
+    base, suffix = os.path.splitext(file)
+    return suffix in ('.gz', '.br') and precompressed(base)
+
+_page_link = re.compile('(<a href=")([^"]*)(">)')
+_any_link = re.compile('(<a href=")([^"]*)(">)|(<img src=")([^"]*)(")([^>]*>)')
+
+def is_local_link(target):
+    "True if `target` names another wiki page or image"
+    return not target.startswith((
+            'http',         # external link
+            '#footnote-',   # footnote link
+            ))
+
+def wiki_config(name, default):
+    """
+    return the `wiki_<name>` server option, converted to the type of `default`
+    """
+    value = config.get('wiki_' + name)
+    if value in (None, ''):
+        return default
+    if isinstance(default, bool):
+        return str(value).lower() in ('1', 'true', 'yes', 'on')
+    if isinstance(default, (int, long)):
+        return int(value)
+    if isinstance(default, tuple):
+        return tuple(int(v) for v in str(value).replace(',', ' ').split())
+    return value
+
+
+class PhaseStats(object):
+    """
+    call counts and timings of the phases of page saves and image requests
+
+    `phase` times a block; `operation` also collects the phases run inside it (in
+    the same thread) and logs them as one json line, at INFO if it took at least
+    `wiki_slow_ms` milliseconds and at DEBUG otherwise
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.local = threading.local()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def add(self, name, elapsed):
+        with self.lock:
+            count, total, longest = self.phases.get(name, (0, 0.0, 0.0))
+            self.phases[name] = count + 1, total + elapsed, max(longest, elapsed)
+        current = getattr(self.local, 'current', None)
+        if current is not None:
+            current[name] = current.get(name, 0.0) + elapsed
+
+    @contextmanager
+    def operation(self, name, **fields):
+        if getattr(self.local, 'current', None) is not None:
+            # nested (e.g. a write from within a write); its phases go to the outer one
+            with self.phase(name):
+                yield
+            return
+        self.local.current = phases = {}
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.local.current = None
+            elapsed = time.time() - start
+            self.add(name, elapsed)
+            level = logging.INFO if elapsed * 1000 >= wiki_config('slow_ms', 500) else logging.DEBUG
+            if _logger.isEnabledFor(level):
+                fields.update(
+                        op=name,
+                        ms=round(elapsed * 1000, 2),
+                        phases=dict((p, round(e * 1000, 2)) for p, e in phases.items()),
+                        )
+                _logger.log(level, 'wiki.stats %s', json.dumps(fields, sort_keys=True, default=str))
+
+    def stats(self):
+        with self.lock:
+            return dict(
+                    (name, {'count': count, 'mean_ms': total * 1000 / count, 'max_ms': longest * 1000})
+                    for name, (count, total, longest) in self.phases.items()
+                    )
+
+wiki_stats = PhaseStats()
+
+def profiled(label, func, *args, **kwds):
+    "call `func` under cProfile, and log its most expensive calls"
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(func, *args, **kwds)
+    finally:
+        report = io.BytesIO()
+        pstats.Stats(profile, stream=report).sort_stats('cumulative').print_stats(40)
+        _logger.info('wiki: profile of %s\n%s', label, report.getvalue())
+
+class RenderCache(object):
+    """
+    rendered documents keyed by a digest of their source and the renderer version
+
+    the in-memory tier is LRU with `size` entries; the optional on-disk tier lives in
+    `path`, is shared by every process using it, and is pruned of its least recently
+    used entries once it grows past `disk_size`
+    """
+
+    def __init__(self, size, path=None, disk_size=0):
+        self.size = size
+        self.path = path
+        self.disk_size = disk_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.disk_hits = self.misses = self.evictions = 0
+        self.disk_writes = 0
+
+    def key(self, source):
+        return sha1(('%s\0%s' % (renderer_version(), source)).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries[key] = value = self.entries.pop(key)
+                return value
+        if self.path is not None:
+            file = self.path / key[:2] / key
+            try:
+                with codecs.open(file, encoding='utf-8') as fh:
+                    value = fh.read()
+            except (IOError, OSError):
+                pass
+            else:
+                try:
+                    # mark it recently used for `prune`
+                    os.utime(file, None)
+                except OSError:
+                    # pruned by another process since it was read; the value is still good
+                    pass
+                with self.lock:
+                    self.disk_hits += 1
+                self._remember(key, value)
+                return value
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def set(self, key, value):
+        self._remember(key, value)
+        if self.path is not None:
+            directory = self.path / key[:2]
+            temp = directory / ('.%s.%d' % (key, os.getpid()))
+            try:
+                if not directory.exists():
+                    directory.makedirs()
+                with codecs.open(temp, 'w', encoding='utf-8') as fh:
+                    fh.write(value)
+                os.rename(temp, directory / key)
+            except (IOError, OSError):
+                _logger.exception('unable to save rendered document to %r', directory)
+                return
+            with self.lock:
+                self.disk_writes += 1
+                prune = self.disk_writes % 1000 == 0
+            if prune:
+                self.prune()
+
+    def _remember(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def prune(self):
+        "remove the least recently used on-disk entries beyond `disk_size`"
+        files = []
+        for directory, _, names in os.walk(self.path):
+            for name in names:
+                file = os.path.join(directory, name)
+                try:
+                    files.append((os.stat(file).st_mtime, file))
+                except OSError:
+                    pass
+        files.sort()
+        for _, file in files[:max(0, len(files) - self.disk_size)]:
+            try:
+                os.unlink(file)
+            except OSError:
+                pass
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                    'entries': len(self.entries),
+                    'size': self.size,
+                    'hits': self.hits,
+                    'disk_hits': self.disk_hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'disk': self.path is not None,
+                    }
+
+render_cache = RenderCache(
+        wiki_config('render_cache_size', 1000),
+        path=WIKI_PATH/'.cache' if wiki_config('render_cache_disk', False) else None,
+        disk_size=wiki_config('render_cache_disk_size', 50000),
+        )
+
+def text2html(name, source_doc):
+    """
+    render `source_doc` -- the result is the body of both the `wiki_doc` column
+    and the on-disk file, once their links have been converted
+    """
+    key = render_cache.key(source_doc)
+    document = render_cache.get(key)
+    if document is None:
+        try:
+            with wiki_stats.phase('render.stonemark'):
+                document = Document(source_doc).to_html()
+        except Exception:
+            _logger.exception('stonemark unable to convert document <%s>', name)
+            return '<pre>' + escape(source_doc) + '</pre>'
+        render_cache.set(key, document)
+    return document
+
+def wiki_document(body):
+    "wrap a converted body for the `wiki_doc` column"
+    return '<div class="wiki">\n' + body + '\n</div>'
+
+def file_document(name, body):
+    "add the title to a converted body for the on-disk file"
+    return '<h1>%s</h1>\n\n%s' % (escape(name), body)
+
+def html_file(title, body):
+    "the complete, utf-8 encoded, html file for `body` -- as stonemark.write_html would write it"
+    page = [
+            stonemark.html_page_head,
+            stonemark.html_page_title % title,
+            stonemark.html_page_css % 'stonemark.css',
+            stonemark.html_page_body,
+            body,
+            stonemark.html_page_post,
+            ]
+    return '\n'.join(page).strip().encode('utf-8')
+
+def image_digest(image):
+    "digest of the decoded bytes of `image` (base64), used as its ETag"
+    if not image:
+        return False
+    return sha1(b64decode(image)).hexdigest()
+
+def image_path(wiki_path, wiki_key, page_key, width=None):
+    """
+    location of an image in the on-disk mirror -- the original if `width` is None,
+    otherwise the rendition `width` pixels wide
+    """
+    path = wiki_path / name_key(wiki_key)
+    if width is not None:
+        path = path / '.renditions' / str(width)
+    return path / page_key
+
+def image_widths():
+    "widths of the renditions offered for each image"
+    return wiki_config('image_widths', (160, 480, IMAGE_WIDTH, 1800))
+
+def rendition_width(size):
+    "the rendition to serve when `size` pixels are asked for"
+    widths = sorted(image_widths())
+    for width in widths:
+        if width >= size:
+            return width
+    return widths[-1]
+
+def image_srcset(url):
+    "srcset and sizes attributes offering every rendition of the image at `url`"
+    return 'srcset="%s" sizes="(max-width: %dpx) 100vw, %dpx"' % (
+            ', '.join('%s&size=%d %dw' % (url, width, width) for width in image_widths()),
+            IMAGE_WIDTH,
+            IMAGE_WIDTH,
+            )
+
+def decode_image(source_img):
+    """
+    decode `source_img` (base64) into a stream, a chunk at a time so the only full
+    copy made is the decoded one
+    """
+    check_bytes(source_img)
+    if '\n' in source_img[:1024]:
+        # encoded with line breaks, so chunks would not line up
+        return io.BytesIO(b64decode(source_img))
+    stream = io.BytesIO()
+    chunk = 64 * 1024
+    for start in range(0, len(source_img), chunk):
+        stream.write(a2b_base64(source_img[start:start+chunk]))
+    stream.seek(0)
+    return stream
+
+def check_image(name, source_img):
+    """
+    raise ERPError if `source_img` (base64) is over the byte or pixel ceilings
+
+    only the start of the image is decoded; if its size cannot be found there the
+    pixel ceiling is left to the resizing
+    """
+    check_bytes(source_img)
+    head = source_img[:256 * 1024]
+    try:
+        size = Image.open(io.BytesIO(b64decode(head[:len(head) // 4 * 4]))).size
+    except Exception:
+        return
+    check_pixels(name, size)
+
+def check_bytes(source_img):
+    max_bytes = wiki_config('image_max_bytes', 50 * 1024 * 1024)
+    if len(source_img) // 4 * 3 > max_bytes:
+        raise ERPError('Wiki Error', 'images are limited to %d MB' % (max_bytes // 1024 // 1024))
+
+def check_pixels(name, size):
+    max_pixels = wiki_config('image_max_pixels', 50 * 1000 * 1000)
+    if size[0] * size[1] > max_pixels:
+        raise ERPError(
+                'Wiki Error',
+                '%s is %dx%d; images are limited to %d megapixels' % (name, size[0], size[1], max_pixels // 1000000),
+                )
+
+def resize_data(name, stream, target_width):
+    """
+    return the image in `stream` scaled down to `target_width`, or None if it is
+    not wider
+
+    JPEGs are decoded straight to about the target size (draft mode), so a large
+    one is never held in memory at full size; the result has the format of the
+    source, whatever the suffix of `name`
+    """
+    stream.seek(0, 2)
+    source_bytes = stream.tell()
+    stream.seek(0)
+    image = Image.open(stream)
+    file_type = image.format
+    width, height = image.size
+    check_pixels(name, image.size)
+    if target_width >= width:
+        return None
+    target_height = int(height * (float(target_width) / width))
+    size = target_width, target_height
+    image.draft(image.mode, size)
+    image.load()
+    decoded = image.size
+    bands = len(image.getbands())
+    image = ImageOps.fit(image, size, Image.ANTIALIAS)
+    if image.mode not in ["1", "L", "P", "RGB", "RGBA"] or (file_type == 'JPEG' and image.mode not in ["L", "RGB"]):
+        image = image.convert("RGB")
+    new_image_stream = io.BytesIO()
+    image.save(new_image_stream, file_type)
+    result = new_image_stream.getvalue()
+    # the largest set of buffers alive at once: the source, the decoded pixels,
+    # the resampled ones, and the result
+    peak = source_bytes + (decoded[0] * decoded[1] + size[0] * size[1]) * bands + len(result)
+    _logger.info(
+            'wiki: %s %dx%d -> %dx%d (decoded at %dx%d), peak memory about %d KB',
+            name, width, height, target_width, target_height, decoded[0], decoded[1], peak // 1024,
+            )
+    image_queue.record_peak(peak)
+    return result
+
+def resize_image(name, source_img, target_width=IMAGE_WIDTH):
+    """
+    return `source_img` (base64) scaled down to `target_width`, if wider, as base64
+    """
+    resized = resize_data(name, decode_image(source_img), target_width)
+    if resized is None:
+        return source_img
+    return b64encode(resized)
+
+def make_rendition(wiki_path, wiki_key, page_key, name, width, data=None):
+    """
+    create the `width` rendition of an image from its on-disk original, or from `data`
+    if given; returns the rendition's path
+    """
+    file = image_path(wiki_path, wiki_key, page_key, width)
+    if data is None:
+        with open(image_path(wiki_path, wiki_key, page_key), 'rb') as fh:
+            resized = resize_data(name, fh, width)
+            if resized is None:
+                fh.seek(0)
+                resized = fh.read()
+    else:
+        resized = resize_data(name, io.BytesIO(data), width) or data
+    if not file.dirname.exists():
+        file.dirname.makedirs()
+    temp = file.dirname / ('.%s.%d' % (page_key, os.getpid()))
+    with open(temp, 'wb') as fh:
+        fh.write(resized)
+    os.rename(temp, file)
+    return file
+
+def render_job(job):
+    """
+    worker-process entry point for bulk regeneration
+
+    `job` is (id, name, source_type, source); returns (id, rendered) where rendered is
+    the unconverted body for text pages, and the wiki-sized image for image pages
+    """
+    id, name, source_type, source = job
+    try:
+        if source_type == 'txt':
+            return id, text2html(name, source)
+        else:
+            return id, resize_image(name, source)
+    except Exception:
+        _logger.exception('unable to render %r', name)
+        # let the parent try again, and report, through the normal write path
+        return id, None
+
+class ImageQueue(object):
+    """
+    background processing of saved images
+
+    saving an image only stores its source and marks it pending; worker threads
+    (per database) pick up pending rows with their own cursors, build `wiki_img` and
+    the on-disk files, and commit them separately
+
+    the pending rows themselves are the queue, so it survives restarts and is shared
+    by every server process; `notify` just wakes the local workers
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.threads = {}
+        self.models = set()
+        self.last_notified = 0
+        self.processed = self.failed = 0
+        self.latency_total = self.latency_max = 0.0
+        self.peak_memory = 0
+
+    def notify(self, db, model):
+        with self.lock:
+            self.models.add((db, model))
+            self.last_notified = time.time()
+            alive = [t for t in self.threads.get(db, []) if t.is_alive()]
+            for i in range(wiki_config('image_workers', 2) - len(alive)):
+                thread = threading.Thread(
+                        target=self._run, args=(db, ),
+                        name='wiki.images.%s.%d' % (db, len(alive)),
+                        )
+                thread.daemon = True
+                thread.start()
+                alive.append(thread)
+            self.threads[db] = alive
+        self.wakeup.set()
+
+    def _run(self, db):
+        threading.current_thread().dbname = db
+        while True:
+            self.wakeup.wait(wiki_config('image_sweep', 60))
+            self.wakeup.clear()
+            while True:
+                while self._process_one(db):
+                    pass
+                # rows notified about may not be committed yet
+                if time.time() - self.last_notified > 5:
+                    break
+                time.sleep(0.5)
+
+    def _process_one(self, db):
+        """
+        process one pending image in `db`; returns False if there were none
+        """
+        with self.lock:
+            models = [m for d, m in self.models if d == db]
+        for model in models:
+            try:
+                registry = RegistryManager.get(db)
+                cr = registry.db.cursor()
+            except Exception:
+                _logger.exception('wiki: unable to check %r for pending images', db)
+                return False
+            try:
+                found = registry[model]._process_pending_image(cr)
+                cr.commit()
+            except Exception:
+                _logger.exception('wiki: error processing images for %s', model)
+                cr.rollback()
+                found = False
+            finally:
+                cr.close()
+            if found:
+                return True
+        return False
+
+    def record(self, latency, failed=False):
+        with self.lock:
+            if failed:
+                self.failed += 1
+            else:
+                self.processed += 1
+                self.latency_total += latency
+                self.latency_max = max(self.latency_max, latency)
+
+    def record_peak(self, peak):
+        "note the estimated peak memory, in bytes, of resizing one image"
+        with self.lock:
+            self.peak_memory = max(self.peak_memory, peak)
+
+    def stats(self):
+        with self.lock:
+            return {
+                    'max_peak_kb': self.peak_memory // 1024,
+                    'workers': sum(len([t for t in ts if t.is_alive()]) for ts in self.threads.values()),
+                    'processed': self.processed,
+                    'failed': self.failed,
+                    'mean_latency': self.processed and self.latency_total / self.processed or 0.0,
+                    'max_latency': self.latency_max,
+                    }
+
+image_queue = ImageQueue()
+
+
+class _ArchiveSink(object):
+    """
+    write-only file for an archive writer; what has been written so far is
+    collected with `take()`
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.offset += len(data)
+
+    def tell(self):
+        return self.offset
+
+    def seek(self, offset, whence=0):
+        # archive writers only "seek" to where they already are
+        if (offset, whence) not in ((self.offset, 0), (0, 1)):
+            raise IOError('archive stream is not seekable')
+
+    def flush(self):
+        pass
+
+    def take(self):
+        chunks, self.chunks = self.chunks, []
+        return ''.join(chunks)
+
+
+def file_digest(file, block_size=65536):
+    "sha1 of the contents of `file`, read a block at a time"
+    digest = sha1()
+    with open(file, 'rb') as fh:
+        for block in iter(lambda: fh.read(block_size), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def site_index(wiki_key, pages):
+    """
+    index page (utf-8 encoded) of an exported wiki
+
+    `pages` is a list of (name, name_key, source_type) in display order
+    """
+    sections = []
+    for title, source_type, suffix in (('Pages', 'txt', '.html'), ('Images', 'img', '')):
+        items = [
+                '<li><a href="%s%s">%s</a></li>' % (key, suffix, escape(name))
+                for name, key, st in pages
+                if st == source_type
+                ]
+        if items:
+            sections.append('<h2>%s</h2>\n<ul>\n%s\n</ul>' % (title, '\n'.join(items)))
+    title = escape(wiki_key)
+    return html_file(title, '<h1>%s</h1>\n%s' % (title, '\n'.join(sections)))
+
+# generated by `export_site`, named so no page ("Index", say) is mirrored as it
+EXPORT_INDEX = '_index.html'
+EXPORT_RESERVED = (EXPORT_INDEX, 'manifest.json')
+
+def export_site(wiki_path, wiki_key, pages, format='zip', since=None):
+    """
+    stream the on-disk mirror of `wiki_key` as an archive, a chunk at a time
+
+    `format` is 'zip', 'tar', or 'tgz'; `pages` is as for `site_index`.  The
+    archive holds the pages, images, stonemark.css, a generated _index.html, and
+    manifest.json, which maps each file to the sha1 of its contents.
+
+    if `since` is the manifest of an earlier export only the files that changed
+    are included, and the new manifest also lists the files since removed in
+    `deleted`; _index.html and manifest.json are always included
+    """
+    if format not in ('zip', 'tar', 'tgz'):
+        raise ValueError('unknown archive format: %r' % (format, ))
+    since = (since or {}).get('files', since or {})
+    directory = key_directory(wiki_path, wiki_key)
+    if not (directory/'stonemark.css').exists():
+        write_css(directory/'stonemark.css')
+    prefix = name_key(wiki_key) + '/'
+    sink = _ArchiveSink()
+    if format == 'zip':
+        archive = zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+    else:
+        archive = tarfile.open(fileobj=sink, mode='w|gz' if format == 'tgz' else 'w|')
+    manifest = {}
+
+    def add(name, file=None, data=None):
+        if format == 'zip':
+            compression = zipfile.ZIP_DEFLATED if name.endswith(('.html', '.css', '.json')) else zipfile.ZIP_STORED
+            if data is None:
+                with open(file, 'rb') as fh:
+                    data = fh.read()
+            archive.writestr(zipfile.ZipInfo(prefix + name, time.localtime()[:6]), data, compression)
+        else:
+            info = tarfile.TarInfo(prefix + name)
+            info.mtime = time.time()
+            info.mode = 0o644
+            if data is None:
+                info.size = os.stat(file).st_size
+                with open(file, 'rb') as fh:
+                    archive.addfile(info, fh)
+            else:
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+
+    for name in sorted(os.listdir(directory)):
+        file = directory / name
+        if name.startswith('.') or is_sibling(name) or not os.path.isfile(file):
+            # renditions, caches, temporary files, and precompressed copies
+            continue
+        if name in EXPORT_RESERVED:
+            _logger.warning('wiki: %r in %r clashes with the generated file; not exported', name, wiki_key)
+            continue
+        manifest[name] = digest = file_digest(file)
+        if since.get(name) == digest:
+            continue
+        add(name, file=file)
+        yield sink.take()
+    index = site_index(wiki_key, pages)
+    manifest[EXPORT_INDEX] = sha1(index).hexdigest()
+    add(EXPORT_INDEX, data=index)
+    contents = {'wiki_key': wiki_key, 'files': manifest}
+    if since:
+        contents['deleted'] = sorted(set(since) - set(manifest) - set(EXPORT_RESERVED))
+    add('manifest.json', data=json.dumps(contents, indent=1, sort_keys=True))
+    archive.close()
+    yield sink.take()
+
+
+# files `import_pages` takes as documents, and as images
+PAGE_SUFFIXES = ('.stonemark', '.txt', '.md')
+IMAGE_SUFFIXES = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tif', '.tiff', '.webp')
+
+def import_files(source):
+    """
+    yield (path, read) for each file in `source` -- a directory, or a zip archive
+    (file name or file object) -- where `read()` returns the file's contents
+
+    hidden files and directories are skipped
+    """
+    if isinstance(source, basestring) and os.path.isdir(source):
+        for directory, subdirs, names in os.walk(source):
+            subdirs[:] = sorted(d for d in subdirs if not d.startswith('.'))
+            for name in sorted(names):
+                if name.startswith('.'):
+                    continue
+                file = os.path.join(directory, name)
+                yield os.path.relpath(file, source), _file_reader(file)
+    elif zipfile.is_zipfile(source):
+        archive = zipfile.ZipFile(source)
+        try:
+            for info in archive.infolist():
+                parts = info.filename.split('/')
+                if info.filename.endswith('/') or any(p.startswith('.') or p == '__MACOSX' for p in parts):
+                    continue
+                yield info.filename, lambda info=info: archive.read(info)
+        finally:
+            archive.close()
+    else:
+        raise ERPError('Wiki Error', '%r is neither a directory nor a zip archive' % (source, ))
+
+def _file_reader(file):
+    def read():
+        with open(file, 'rb') as fh:
+            return fh.read()
+    return read
+
+def import_name(path):
+    """
+    (name, source type) of the page for the file at `path`, or None if it is neither
+    a document nor an image
+
+    documents are named for the file, without its suffix and with underscores as
+    spaces; images keep their suffix, as links to them do
+    """
+    if isinstance(path, bytes):
+        path = path.decode('utf-8', 'replace')
+    base = os.path.basename(path)
+    stem, suffix = os.path.splitext(base)
+    if suffix.lower() in IMAGE_SUFFIXES:
+        return base.strip(), 'img'
+    elif suffix.lower() in PAGE_SUFFIXES:
+        return stem.replace('_', ' ').strip(), 'txt'
+    return None
+
+
+class FileWriter(object):
+    """
+    changes to the on-disk mirror, held per transaction and applied once it commits
+
+    files are queued with `write` and `delete`; only the last change queued for a
+    file is applied, a file whose contents are unchanged is left alone, and writes
+    go to a temporary file that is then renamed into place.  A rollback, or closing
+    the cursor without committing, discards the queue.
+
+    pages and stylesheets also get a sibling per entry in `ENCODINGS` (such as
+    `page.html.gz`), so they can be served compressed at no cost per request
+
+    `after_commit` queues a call to make once the files have been updated
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.css = set()
+        self.written = self.unchanged = self.deleted = self.discarded = self.errors = 0
+
+    def write(self, cr, file, data):
+        self._queue(cr)['files'][file] = data
+
+    def delete(self, cr, file):
+        self._queue(cr)['files'][file] = None
+
+    def link(self, cr, file, source):
+        "make `file` a hard link to (or, failing that, a copy of) `source`"
+        self._queue(cr)['files'][file] = _Link(source)
+
+    def after_commit(self, cr, func, *args):
+        self._queue(cr)['calls'].append((func, args))
+
+    def ensure_css(self, cr, directory):
+        "queue stonemark.css for `directory` unless it is already there"
+        if directory in self.css:
+            return
+        css = directory / 'stonemark.css'
+        if css.exists() and all(os.path.exists(css + suffix) for _, suffix, _ in ENCODINGS):
+            self.css.add(directory)
+        else:
+            self.write(cr, css, stonemark.default_css.encode('utf-8'))
+
+    def _queue(self, cr):
+        queue = getattr(cr, '_wiki_files', None)
+        if queue is None:
+            queue = cr._wiki_files = {'files': OrderedDict(), 'calls': []}
+            self._hook(cr)
+        return queue
+
+    def _hook(self, cr):
+        # OpenERP cursors have no commit hooks, so wrap this one's methods; only a
+        # weak reference is kept, as cursors have a __del__ and must not be in a cycle
+        cursor = weakref.ref(cr)
+        cls = type(cr)
+        def commit():
+            result = cls.commit(cursor())
+            self.apply(cursor())
+            return result
+        def rollback():
+            self.discard(cursor())
+            return cls.rollback(cursor())
+        def close(*args, **kwds):
+            self.discard(cursor())
+            return cls.close(cursor(), *args, **kwds)
+        cr.commit, cr.rollback, cr.close = commit, rollback, close
+
+    def discard(self, cr):
+        queue = getattr(cr, '_wiki_files', None)
+        if queue and queue['files']:
+            with self.lock:
+                self.discarded += len(queue['files'])
+        cr._wiki_files = None
+
+    def apply(self, cr):
+        queue = getattr(cr, '_wiki_files', None)
+        cr._wiki_files = None
+        if not queue:
+            return
+        with wiki_stats.phase('files.apply'):
+            self._apply(queue['files'])
+        for func, args in queue['calls']:
+            try:
+                func(*args)
+            except Exception:
+                _logger.exception('wiki: error after commit in %r', func)
+
+    def _apply(self, files):
+        for file, data in files.items():
+            try:
+                if data is None:
+                    if os.path.exists(file):
+                        os.unlink(file)
+                        self._count('deleted')
+                    if precompressed(file):
+                        for _, suffix, _ in ENCODINGS:
+                            if os.path.exists(file + suffix):
+                                os.unlink(file + suffix)
+                elif isinstance(data, _Link):
+                    if os.path.exists(file) and os.path.samefile(file, data.source):
+                        self._count('unchanged')
+                    else:
+                        self._replace(file, link=data.source)
+                        self._count('written')
+                elif self._unchanged(file, data):
+                    self._count('unchanged')
+                    if precompressed(file):
+                        self._compress(file, data, missing=True)
+                else:
+                    self._replace(file, data)
+                    self._count('written')
+                    if precompressed(file):
+                        self._compress(file, data)
+                    if file.endswith('/stonemark.css'):
+                        self.css.add(file.dirname)
+            except (IOError, OSError):
+                _logger.exception('wiki: unable to update %r', file)
+                self._count('errors')
+
+    def _unchanged(self, file, data):
+        try:
+            if os.stat(file).st_size != len(data):
+                return False
+        except OSError:
+            return False
+        return file_digest(file) == sha1(data).hexdigest()
+
+    def _compress(self, file, data, missing=False):
+        "write the precompressed siblings of `file` (only those not there, if `missing`)"
+        with wiki_stats.phase('files.compress'):
+            for _, suffix, compress in ENCODINGS:
+                if not (missing and os.path.exists(file + suffix)):
+                    self._replace(file + suffix, compress(data))
+
+    def _replace(self, file, data=None, link=None):
+        directory = file.dirname
+        if not directory.exists():
+            directory.makedirs()
+        temp = directory / ('.%s.%d.%d' % (os.path.basename(file), os.getpid(), threading.current_thread().ident))
+        try:
+            if link is not None:
+                try:
+                    os.link(link, temp)
+                except OSError:
+                    # e.g. a different file system
+                    shutil.copyfile(link, temp)
+            else:
+                with open(temp, 'wb') as fh:
+                    fh.write(data)
+            os.rename(temp, file)
+        except Exception:
+            if os.path.exists(temp):
+                os.unlink(temp)
+            raise
+
+    def _count(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def stats(self):
+        with self.lock:
+            return {
+                    'written': self.written,
+                    'unchanged': self.unchanged,
+                    'deleted': self.deleted,
+                    'discarded': self.discarded,
+                    'errors': self.errors,
+                    }
+
+file_writer = FileWriter()
+
+
+class _Link(object):
+    __slots__ = ('source', )
+
+    def __init__(self, source):
+        self.source = source
+
+
+class BlobStore(object):
+    """
+    image bytes, stored once per distinct content as `path/<digest[:2]>/<digest>`
+
+    the `wiki_blob` table counts the page columns referring to each blob.  A blob no
+    longer referred to is kept for a grace period -- the transaction releasing it
+    may yet be rolled back, or the same image saved again -- and then removed by
+    `purge`.  Both `put` and `purge` touch the file only while holding the blob's
+    row lock, so a blob being saved again is never removed from under it.
+
+    `put` writes the file at once, so that the rest of the transaction can read it;
+    if the transaction is then rolled back the file has no row, and `purge` removes
+    it once it is older than the grace period
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def init(self, cr):
+        cr.execute(dedent('''
+                CREATE TABLE IF NOT EXISTS wiki_blob (
+                    digest varchar(40) PRIMARY KEY,
+                    size integer NOT NULL,
+                    refs integer NOT NULL DEFAULT 0,
+                    released timestamp
+                    )
+                '''))
+
+    def file(self, digest):
+        return self.path / digest[:2] / digest
+
+    def put(self, cr, data, refs=1):
+        "store `data` (if new) and add `refs` references to it; returns its digest"
+        digest = sha1(data).hexdigest()
+        cr.execute(dedent('''
+                INSERT INTO wiki_blob (digest, size, refs) VALUES (%s, %s, %s)
+                ON CONFLICT (digest) DO UPDATE SET refs = wiki_blob.refs + EXCLUDED.refs, released = NULL
+                '''), (digest, len(data), refs))
+        file = self.file(digest)
+        if not file.exists():
+            directory = file.dirname
+            if not directory.exists():
+                directory.makedirs()
+            temp = directory / ('.%s.%d.%d' % (digest, os.getpid(), threading.current_thread().ident))
+            with open(temp, 'wb') as fh:
+                fh.write(data)
+            os.rename(temp, file)
+        return digest
+
+    def release(self, cr, digests):
+        "drop one reference for each of `digests`"
+        for digest in digests:
+            cr.execute(dedent('''
+                    UPDATE wiki_blob
+                    SET refs = refs - 1,
+                        released = CASE WHEN refs <= 1 THEN now() at time zone 'UTC' ELSE released END
+                    WHERE digest = %s
+                    '''), (digest, ))
+
+    def get(self, digest):
+        "the stored bytes of `digest`, or None"
+        try:
+            with open(self.file(digest), 'rb') as fh:
+                return fh.read()
+        except (IOError, OSError):
+            _logger.error('wiki: blob %s is missing', digest)
+            return None
+
+    def size(self, digest):
+        try:
+            return os.stat(self.file(digest)).st_size
+        except OSError:
+            return 0
+
+    def purge(self, cr, grace, dry_run=False):
+        """
+        remove the blobs unreferenced for at least `grace` seconds, and the files
+        older than that without any row; returns [(digest, size)]
+        """
+        cr.execute(dedent('''
+                %s wiki_blob
+                WHERE refs <= 0 AND released < (now() at time zone 'UTC') - interval '1 second' * %%s
+                %s
+                ''' % (
+                    ('SELECT digest, size FROM', '') if dry_run else ('DELETE FROM', 'RETURNING digest, size')
+                    )), (grace, ))
+        purged = cr.fetchall()
+        if not dry_run:
+            for digest, size in purged:
+                try:
+                    os.unlink(self.file(digest))
+                except OSError:
+                    pass
+        for digest, size in self._orphans(cr, grace, dry_run):
+            if not dry_run:
+                # take the digest's row lock, as `put` does, in case it is being saved again
+                cr.execute(dedent('''
+                        INSERT INTO wiki_blob (digest, size, refs, released)
+                        VALUES (%s, %s, 0, now() at time zone 'UTC')
+                        ON CONFLICT (digest) DO NOTHING
+                        RETURNING digest
+                        '''), (digest, size))
+                if cr.fetchone() is None:
+                    continue
+                try:
+                    os.unlink(self.file(digest))
+                except OSError:
+                    pass
+                cr.execute('DELETE FROM wiki_blob WHERE digest = %s', (digest, ))
+            purged.append((digest, size))
+        return purged
+
+    def _orphans(self, cr, grace, dry_run=False):
+        """
+        [(digest, size)] of the blob files older than `grace` seconds that have no row --
+        written by transactions that were rolled back; stale temporary files are
+        removed along the way
+        """
+        if not self.path.exists():
+            return []
+        cutoff = time.time() - grace
+        candidates = {}
+        for directory, subdirs, names in os.walk(self.path):
+            for name in names:
+                file = os.path.join(directory, name)
+                try:
+                    stat = os.stat(file)
+                except OSError:
+                    continue
+                if stat.st_mtime >= cutoff:
+                    continue
+                if not name.startswith('.'):
+                    candidates[name] = stat.st_size
+                elif not dry_run:
+                    # left by a crashed `put`
+                    os.unlink(file)
+        orphans = []
+        digests = sorted(candidates)
+        for start in range(0, len(digests), 1000):
+            batch = tuple(digests[start:start+1000])
+            cr.execute('SELECT digest FROM wiki_blob WHERE digest IN %s', (batch, ))
+            known = set(r[0] for r in cr.fetchall())
+            orphans.extend((digest, candidates[digest]) for digest in batch if digest not in known)
+        return orphans
+
+blob_store = BlobStore(BLOB_PATH)
+
+
+class LinkGraphCache(object):
+    """
+    link-graph reports keyed by (database, table) and then by report and arguments
+
+    a (database, table) is invalidated as a whole whenever its links change; as
+    other processes' changes are not seen, entries also expire after `max_age`
+    seconds
+    """
+
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.invalidations = 0
+
+    def get(self, graph, key):
+        with self.lock:
+            entry = self.entries.get(graph, {}).get(key)
+            if entry is not None and time.time() - entry[0] < self.max_age:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def set(self, graph, key, value):
+        with self.lock:
+            self.entries.setdefault(graph, {})[key] = time.time(), value
+
+    def invalidate(self, graph):
+        with self.lock:
+            if self.entries.pop(graph, None):
+                self.invalidations += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                    'graphs': len(self.entries),
+                    'reports': sum(len(r) for r in self.entries.values()),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'invalidations': self.invalidations,
+                    }
+
+link_cache = LinkGraphCache(wiki_config('link_cache_age', 300))
+
+def stats_report():
+    "everything this process counts, for the `stats` method and /wiki/stats"
+    return {
+            'phases': wiki_stats.stats(),
+            'render_cache': render_cache.stats(),
+            'link_cache': link_cache.stats(),
+            'files': file_writer.stats(),
+            'images': image_queue.stats(),
+            }
+
+def move_directory(old_path, new_path):
+    "move an on-disk wiki directory; merge it into `new_path` if that already exists"
+    file_writer.css.discard(old_path)
+    file_writer.css.discard(new_path)
+    if not old_path.exists():
+        return
+    if not new_path.exists():
+        os.rename(old_path, new_path)
+        return
+    for name in os.listdir(old_path):
+        source, target = old_path / name, new_path / name
+        if os.path.isdir(source):
+            move_directory(source, target)
+        else:
+            os.rename(source, target)
+    os.rmdir(old_path)
+
+def remove_directory(path):
+    """
+    remove an on-disk wiki directory that no longer has any pages -- only its
+    stylesheet (and its precompressed siblings) and (empty) rendition directories
+    """
+    if not path.exists():
+        return
+    for directory, subdirs, names in os.walk(path, topdown=False):
+        for name in names:
+            if directory == path and name.startswith('stonemark.css'):
+                os.unlink(os.path.join(directory, name))
+        try:
+            os.rmdir(directory)
+        except OSError:
+            _logger.warning('wiki: %r is not empty; left in place', directory)
+            return
+    file_writer.css.discard(path)
 
 def unique(model, cr, uid, ids, context=None):
     seen = set()
@@ -153,14 +1404,60 @@ class wiki_key(osv.Model):
     _description = 'wiki key'
     _order = 'name'
 
+    def _key_names(self, cr, ids):
+        cr.execute('SELECT id, name FROM %s WHERE id IN %%s' % (self._table, ), (tuple(ids), ))
+        return dict(cr.fetchall())
+
     def _get_page_ids(self, cr, uid, ids, field_name, arg, context=None):
         if isinstance(ids, (int, long)):
             ids = [ids]
-        res = {}.fromkeys(ids, [])
-        wiki_doc = self.pool.get('wiki.page')
-        for key_id in ids:
-            wiki_key = self.read(cr, uid, key_id, fields=['name'], context=context)
-            res[key_id] = wiki_doc.search(cr, uid, [('wiki_key','=',wiki_key['name'])], context=context)
+        res = dict((id, []) for id in ids)
+        if not ids:
+            return res
+        names = self._key_names(cr, ids)
+        keys = dict((name, id) for id, name in names.items())
+        cr.execute(
+                'SELECT wiki_key, id FROM %s WHERE wiki_key IN %%s ORDER BY name'
+                % (self.pool.get('wiki.page')._table, ),
+                (tuple(keys) or (None, ), ),
+                )
+        for wiki_key, page_id in cr.fetchall():
+            res[keys[wiki_key]].append(page_id)
+        return res
+
+    def _get_page_stats(self, cr, uid, ids, field_names, arg, context=None):
+        """
+        page statistics of each key in `ids`, from a single aggregate query
+        """
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        res = dict(
+                (id, {'page_count': 0, 'image_count': 0, 'empty_count': 0, 'last_modified': False})
+                for id in ids
+                )
+        if not ids:
+            return res
+        names = self._key_names(cr, ids)
+        keys = dict((name, id) for id, name in names.items())
+        cr.execute(dedent('''
+                SELECT wiki_key,
+                       count(*),
+                       count(CASE WHEN source_type = 'img' THEN 1 END),
+                       count(CASE WHEN is_empty THEN 1 END),
+                       max(coalesce(write_date, create_date))
+                FROM %s
+                WHERE wiki_key IN %%s
+                GROUP BY wiki_key
+                ''' % (self.pool.get('wiki.page')._table, )),
+                (tuple(keys) or (None, ), ),
+                )
+        for wiki_key, page_count, image_count, empty_count, last_modified in cr.fetchall():
+            res[keys[wiki_key]] = {
+                    'page_count': page_count,
+                    'image_count': image_count,
+                    'empty_count': empty_count,
+                    'last_modified': last_modified and last_modified.strftime(DEFAULT_SERVER_DATETIME_FORMAT),
+                    }
         return res
 
     _columns = {
@@ -168,6 +1465,10 @@ class wiki_key(osv.Model):
         'private': fields.boolean('System', help='Omit from Knowledge -> Wiki -> Pages ?', readonly=True),
         'template': fields.text('Template'),
         'page_ids': fields.function(_get_page_ids, string='Pages', type='one2many', obj='wiki.page'),
+        'page_count': fields.function(_get_page_stats, multi='stats', string='Pages', type='integer'),
+        'image_count': fields.function(_get_page_stats, multi='stats', string='Images', type='integer'),
+        'empty_count': fields.function(_get_page_stats, multi='stats', string='Empty', type='integer'),
+        'last_modified': fields.function(_get_page_stats, multi='stats', string='Last Modified', type='datetime'),
         }
 
     _constraints = [
@@ -195,23 +1496,46 @@ class wiki_key(osv.Model):
     def write(self, cr, uid, ids, values, context=None):
         if isinstance(ids, (int, long)):
             ids = [ids]
+        renamed = []
         if 'name' in values:
-            current = self.read(cr, uid, ids, values, context=context)
-            current_name = current[0]['name']
+            renamed = [
+                    r['name']
+                    for r in self.read(cr, uid, ids, ['name'], context=context)
+                    if r['name'] != values['name']
+                    ]
         res = super(wiki_key, self).write(cr, uid, ids, values, context=context)
-        if 'name' in values:
-            # update any pages in this categary
-            ctx = context or {}
-            ctx['wiki-maintenance'] = True
-            wiki_page = self.pool.get('wiki.page')
-            affected_ids = wiki_page.search(cr, uid, [('wiki_key','=',current_name)], context=context)
-            wiki_page.write(cr, uid, affected_ids, {'wiki_key': values['name']}, context=ctx)
-            # and rename the on-disk directory
-            old_path = wiki_doc._wiki_path / name_key(current_name)
-            new_path = wiki_doc._wiki_path / name_key(values['name'])
-            old_path.move(new_path)
+        for current_name in renamed:
+            self._rename_pages(cr, uid, current_name, values['name'], context=context)
         return res
 
+    def _rename_pages(self, cr, uid, old_name, new_name, context=None):
+        """
+        move every page in `old_name` to `new_name`, and its on-disk directory with them
+
+        each wiki table is updated with a single statement; only the pages in other
+        keys that link into this one (whose files use "../<key>/" links) need rendering
+        again, and are marked stale
+        """
+        for model in ['wiki.page'] + sorted(wiki_doc._wiki_tables):
+            pages = self.pool.get(model)
+            cr.execute(
+                    'UPDATE %s SET wiki_key=%%s WHERE wiki_key=%%s RETURNING id' % (pages._table, ),
+                    (new_name, old_name),
+                    )
+            ids = [r[0] for r in cr.fetchall()]
+            if not ids:
+                continue
+            pages._invalidate_links(cr)
+            pages._mark_stale(cr, ids, exclude_key=new_name)
+        # the directory is moved once committed, after any files already queued
+        old_path = wiki_doc._wiki_path / name_key(old_name)
+        new_path = wiki_doc._wiki_path / name_key(new_name)
+        if old_path != new_path:
+            # pages written to either name before the move may not find a stylesheet
+            file_writer.css.discard(old_path)
+            file_writer.css.discard(new_path)
+            file_writer.after_commit(cr, move_directory, old_path, new_path)
+
     def unlink(self, cr, uid, ids, context=None):
         if isinstance(ids, (int, long)):
             ids = [ids]
@@ -221,8 +1545,8 @@ class wiki_key(osv.Model):
             raise ERPError('Wiki Error', 'Cannot delete categories that are in use.')
         res = super(wiki_key, self).unlink(cr, uid, ids, context=context)
         for name in names:
-            wiki_path = wiki_doc._wiki_path / name_key(name)
-            wiki_path.rmdir()
+            # after the pages' own files are gone
+            file_writer.after_commit(cr, remove_directory, wiki_doc._wiki_path / name_key(name))
         return res
 
 
@@ -238,18 +1562,52 @@ class wiki_doc(osv.Model):
 
     def _calc_is_empty(self, cr, uid, ids, field_name, arg, context=None):
         res = {}.fromkeys(ids, False)
-        for rec in self.read(cr, uid, ids, ['source_doc','source_img','source_type'], context=context):
+        empty_image = (False, image_digest(placeholder))
+        for rec in self.read(cr, uid, ids, ['source_doc','source_img_digest','source_type'], context=context):
             type = rec['source_type']
             doc = rec['source_doc']
-            img = rec['source_img']
+            img = rec['source_img_digest']
             if type == 'txt' and doc in (False, '', '[under construction]', '[[under construction]]'):
                 res[rec['id']] = True
-            elif type == 'img' and img in (False, placeholder):
+            elif type == 'img' and img in empty_image:
                 res[rec['id']] = True
             else:
                 res[rec['id']] = False
         return res
 
+    def _get_image(self, cr, uid, ids, field_name, arg, context=None):
+        """
+        `source_img` and `wiki_img` are kept in the blob store, and only their digests
+        in the table; with `bin_size` in the context just their sizes are returned
+        """
+        context = context or {}
+        res = dict.fromkeys(ids, False)
+        if not ids:
+            return res
+        cr.execute(
+                'SELECT id, %s_digest FROM %s WHERE id IN %%s' % (field_name, self._table),
+                (tuple(ids), ),
+                )
+        for id, digest in cr.fetchall():
+            if not digest:
+                continue
+            if context.get('bin_size'):
+                res[id] = human_size(blob_store.size(digest))
+            else:
+                data = blob_store.get(digest)
+                res[id] = data is not None and b64encode(data)
+        return res
+
+    def _set_image(self, cr, uid, id, field_name, value, arg, context=None):
+        column = field_name + '_digest'
+        cr.execute('SELECT %s FROM %s WHERE id=%%s' % (column, self._table), (id, ))
+        [old] = cr.fetchone()
+        new = value and blob_store.put(cr, b64decode(value)) or None
+        if old:
+            blob_store.release(cr, [old])
+        cr.execute('UPDATE %s SET %s=%%s WHERE id=%%s' % (self._table, column), (new, id))
+        return True
+
     def _select_key(self, cr, uid, context=None):
         key = self.pool.get('wiki.key')
         if 'wiki_key' in self._defaults:
@@ -263,6 +1621,22 @@ class wiki_doc(osv.Model):
         res = [(r['name'], r['name']) for r in res]
         return res
 
+    def _get_full_text(self, cr, uid, ids, field_name, arg, context=None):
+        return dict.fromkeys(ids, False)
+
+    def _search_full_text(self, cr, uid, model, field_name, domain, context=None):
+        """
+        pages matching each term of `domain`, or with a negative operator (`!=`,
+        `not ilike`, ...) not matching it; the search's own order applies
+        """
+        res = []
+        for field, operator, value in domain:
+            if isinstance(value, (list, tuple)):
+                value = ' '.join(value)
+            ids = self._text_match_ids(cr, value or '')
+            res.append(('id', 'not in' if operator in NEGATIVE_TERM_OPERATORS else 'in', ids))
+        return res
+
     _columns = {
         'wiki_key': fields.selection(_select_key, required=True, string='Wiki Key', help="each logical wiki has its own wiki key"),
         'name': fields.char('Name', size=64, required=True),
@@ -273,9 +1647,34 @@ class wiki_doc(osv.Model):
                 'Source Type',
                 ),
         'source_doc': fields.text('Source Document', ),
-        'source_img': fields.binary('Source Image', ),
+        'source_img': fields.function(
+            _get_image,
+            fnct_inv=_set_image,
+            string='Source Image',
+            type='binary',
+            ),
+        'source_img_digest': fields.char('Source image digest', size=40, readonly=True),
         'wiki_doc': fields.raw_html('Wiki Document'),
-        'wiki_img': fields.binary(string="Wiki-sized image"),
+        'wiki_img': fields.function(
+            _get_image,
+            fnct_inv=_set_image,
+            string='Wiki-sized image',
+            type='binary',
+            ),
+        'wiki_img_digest': fields.char('Wiki-sized image digest', size=40, readonly=True),
+        'img_state': fields.selection(
+            (('pending', 'Pending'), ('done', 'Done'), ('failed', 'Failed')),
+            'Image Processing',
+            readonly=True,
+            ),
+        'img_queued': fields.datetime('Image queued at', readonly=True),
+        'full_text': fields.function(
+            _get_full_text,
+            fnct_search=_search_full_text,
+            string='Content',
+            type='char',
+            help='search the page names and text',
+            ),
         'forward_links': fields.many2many(
             'wiki.page',
             rel='wiki_links', id1='src', id2='tgt',
@@ -291,14 +1690,32 @@ class wiki_doc(osv.Model):
             string='Empty?',
             type='boolean',
             store={
-                'wiki.page': (self_ids, ['source_doc','source_type','source_img'], 10),
+                'wiki.page': (self_ids, ['source_doc','source_type','source_img','source_img_digest'], 10),
                 },
             ),
+        'fingerprint': fields.char(
+            'Render Fingerprint', size=40, readonly=True,
+            help='digest of the source, renderer version, and link targets last used to render this page',
+            ),
+        'is_stub': fields.boolean(
+            'Created by a Link', readonly=True,
+            help='created empty because another page linked to it; removed again once nothing does',
+            ),
+        'stub_released': fields.datetime(
+            'Unlinked since', readonly=True,
+            help='when the last page linking to this stub stopped doing so',
+            ),
+        'stale': fields.boolean(
+            'Needs Rendering', readonly=True,
+            help='a page this one links to has been renamed, moved to another wiki key, or deleted',
+            ),
         }
 
     _defaults = {
         'source_type': 'txt',
         'top_level': False,
+        'is_stub': False,
+        'stale': False,
         }
 
     _sql_constraints = [
@@ -312,7 +1729,32 @@ class wiki_doc(osv.Model):
             self.__class__._wiki_tables.add(self._name)
 
     def _auto_init(self, cr, context=None):
+        # before the ORM drops the old binary columns
+        self._migrate_images(cr)
+        cr.execute(
+                "SELECT 1 FROM information_schema.columns WHERE table_name=%s AND column_name='is_stub'",
+                (self._table, ),
+                )
+        mark_stubs = not cr.fetchone()
+        cr.execute(
+                "SELECT 1 FROM information_schema.columns WHERE table_name=%s AND column_name='stub_released'",
+                (self._table, ),
+                )
+        mark_released = not cr.fetchone()
         res = super(wiki_doc, self)._auto_init(cr, context)
+        if mark_stubs:
+            # rows still exactly as _create_stubs made them
+            cr.execute(dedent('''
+                    UPDATE %s SET is_stub = true
+                    WHERE (source_type = 'txt' AND source_doc = '[[under construction]]')
+                       OR (source_type = 'img' AND source_img_digest = %%s)
+                    ''' % (self._table, )), (image_digest(placeholder), ))
+        if mark_released:
+            # when they lost their last link is unknown; start the grace period now
+            cr.execute('SELECT id FROM %s WHERE is_stub' % (self._table, ))
+            self._release_stubs(cr, [r[0] for r in cr.fetchall()])
+        self._init_search(cr)
+        cr.execute('CREATE INDEX IF NOT EXISTS %s_stale_idx ON %s (id) WHERE stale' % (self._table, self._table))
         if self.__class__.__name__ == 'wiki_doc':
             subwikis = [
                     (rec['name'], name_key(rec['name']))
@@ -320,140 +1762,1110 @@ class wiki_doc(osv.Model):
                     ]
         else:
             subwikis = [(self._defaults['wiki_key'], name_key(self._defaults['wiki_key']))]
-        # get our own cursor in case something fails
         db_name = threading.current_thread().dbname
-        db = openerp.sql_db.db_connect(db_name)
-        wiki_cr = db.cursor()
+        if wiki_config('regenerate_background', False):
+            thread = threading.Thread(
+                    target=self._regenerate_background, args=(db_name, subwikis, context),
+                    name='wiki.regenerate.%s.%s' % (db_name, self._table),
+                    )
+            thread.daemon = True
+            thread.start()
+        else:
+            self._regenerate_all(db_name, subwikis, context=context)
+        return res
+
+    def _regenerate_background(self, db_name, subwikis, context=None):
+        threading.current_thread().dbname = db_name
+        # wait for the registry to finish loading, and then use its (complete) model
+        for _ in range(600):
+            registry = RegistryManager.registries.get(db_name)
+            if registry is not None and getattr(registry, 'ready', False):
+                break
+            time.sleep(1)
+        else:
+            _logger.error('wiki: %s -- registry never became ready; files not regenerated', self._name)
+            return
         try:
-            for name, path in subwikis:
-                wiki_path = self._wiki_path / path
-                # if not wiki_path.exists():
-                _logger.info('wiki: writing files for %r to %r', name, wiki_path)
-                wiki_path.makedirs()
-                for rec in self.browse(wiki_cr, SUPERUSER_ID, [('wiki_key','=',name)], context=context):
-                    wiki_cr.execute(dedent('''
-                            UPDATE %s
-                            SET name=%%s, name_key=%%s
-                            WHERE id=%%s
-                            ''' % (self._table, )), (rec.name.strip(), name_key(rec.name.strip()), rec.id)
-                            )
-                    try:
-                        if rec.source_type == 'txt':
-                            self.write(wiki_cr, SUPERUSER_ID, rec.id, {'source_doc': rec.source_doc}, context=context)
-                        elif rec.source_type == 'img':
-                            self.write(wiki_cr, SUPERUSER_ID, rec.id, {'source_img': rec.source_img}, context=context)
-                        else:
-                            _logger.error('rec id %d is missing `source_type`', rec.id)
-                    except Exception:
-                        _logger.exception('error processing %r' % rec.name)
-            wiki_cr.commit()
+            registry[self._name]._regenerate_all(db_name, subwikis, context=context)
+        except Exception:
+            _logger.exception('wiki: %s -- unable to regenerate files', self._name)
+
+    def _regenerate_all(self, db_name, subwikis, context=None):
+        """
+        bring the on-disk files of `subwikis` up to date
+
+        a session advisory lock makes sure only one server process does this at a
+        time; any other skips it and goes on starting up
+        """
+        lock = ('wiki.regenerate', self._table)
+        # get our own cursor in case something fails
+        wiki_cr = openerp.sql_db.db_connect(db_name).cursor()
+        try:
+            wiki_cr.execute('SELECT pg_try_advisory_lock(hashtext(%s), hashtext(%s))', lock)
+            if not wiki_cr.fetchone()[0]:
+                _logger.info('wiki: %s -- being regenerated by another process; skipping', self._name)
+                return
+            try:
+                self._regenerate_locked(wiki_cr, db_name, subwikis, context=context)
+            finally:
+                # the lock belongs to the connection, which outlives this cursor
+                wiki_cr.rollback()
+                wiki_cr.execute('SELECT pg_advisory_unlock(hashtext(%s), hashtext(%s))', lock)
+                wiki_cr.commit()
         finally:
             wiki_cr.close()
+
+    def _regenerate_locked(self, wiki_cr, db_name, subwikis, context=None):
+        total_skipped = total_rebuilt = 0
+        for name, path in subwikis:
+            wiki_path = self._wiki_path / path
+            _logger.info('wiki: checking files for %r in %r', name, wiki_path)
+            wiki_path.makedirs()
+            started = time.time()
+            def batch_done(checked, total):
+                # keep the transaction (and the queued files) from growing without limit
+                wiki_cr.commit()
+                _logger.info(
+                        'wiki: %r -- %d of %d pages checked (%.1f pages/s)',
+                        name, checked, total, checked / max(time.time() - started, 0.001),
+                        )
+            skipped, rebuilt = self._regenerate_pages(wiki_cr, name, context=context, batch_done=batch_done)
+            wiki_cr.commit()
+            _logger.info('wiki: %r -- %d pages skipped, %d pages rebuilt', name, skipped, rebuilt)
+            total_skipped += skipped
+            total_rebuilt += rebuilt
+        _logger.info(
+                'wiki: %s -- %d pages skipped, %d pages rebuilt (renderer %s)',
+                self._name, total_skipped, total_rebuilt, renderer_version(),
+                )
+        wiki_cr.execute("SELECT count(*) FROM %s WHERE img_state='pending'" % (self._table, ))
+        pending = wiki_cr.fetchone()[0]
+        if pending:
+            _logger.info('wiki: %s -- %d images waiting to be processed', self._name, pending)
+            image_queue.notify(db_name, self._name)
+
+    def _regenerate_pages(self, cr, wiki_key, context=None, batch_done=None):
+        """
+        rebuild pages in `wiki_key` whose fingerprint is out of date or whose file is missing
+
+        returns (skipped, rebuilt) counts
+        """
+        skipped = rebuilt = 0
+        stale_ids = []
+        ids = self.search(cr, SUPERUSER_ID, [('wiki_key','=',wiki_key)], context=context)
+        for row in self._fingerprint_rows(cr, ids):
+            id, name, current_key, source_type = row[:4]
+            stripped = name.strip()
+            if stripped != name or name_key(stripped) != current_key:
+                cr.execute(dedent('''
+                        UPDATE %s
+                        SET name=%%s, name_key=%%s
+                        WHERE id=%%s
+                        ''' % (self._table, )), (stripped, name_key(stripped), id)
+                        )
+                stale_ids.append(id)
+                continue
+            if source_type == 'txt':
+                files = [self._wiki_path / name_key(wiki_key) / current_key + '.html']
+            else:
+                files = [
+                        image_path(self._wiki_path, wiki_key, current_key),
+                        image_path(self._wiki_path, wiki_key, current_key, IMAGE_WIDTH),
+                        ]
+            if row[-1] != row[-2] or not all(f.exists() for f in files):
+                stale_ids.append(id)
+            else:
+                skipped += 1
+        progress = None
+        if batch_done is not None:
+            progress = lambda done: batch_done(skipped + done, len(ids))
+        rebuilt = self._regenerate_ids(cr, stale_ids, context=context, progress=progress)
+        return skipped, rebuilt
+
+    def _regenerate_ids(self, cr, ids, context=None, progress=None):
+        """
+        rewrite `ids` from their own sources -- in worker processes if there are
+        enough of them and `wiki_render_workers` is set
+
+        `progress`, if given, is called with the number done after each batch;
+        returns the number rebuilt
+        """
+        workers = wiki_config('render_workers', 0)
+        batch_size = wiki_config('render_batch', 200)
+        # forking from the background thread would copy locks held by the threads
+        # still loading the server into the workers, where nothing releases them
+        if workers > 1 and len(ids) > batch_size and not wiki_config('regenerate_background', False):
+            return self._regenerate_parallel(cr, ids, workers, batch_size, context=context, progress=progress)
+        return self._regenerate_serial(cr, ids, batch_size, context=context, progress=progress)
+
+    def _regenerate_serial(self, cr, ids, batch_size, context=None, progress=None):
+        rebuilt = 0
+        for done, rec in enumerate(self.browse(cr, SUPERUSER_ID, ids, context=context), 1):
+            rebuilt += self._regenerate_page(cr, rec, context=context)
+            if progress is not None and done % batch_size == 0:
+                progress(done)
+        return rebuilt
+
+    def _regenerate_page(self, cr, rec, rendered=None, context=None):
+        """
+        rewrite `rec` from its own source, using `rendered` output if already available
+
+        returns 1 if rebuilt, 0 otherwise
+        """
+        context = dict(context or {}, wiki_image_sync=True)
+        if rendered is not None:
+            context['wiki_rendered'] = {rec.id: rendered}
+        try:
+            if rec.source_type == 'txt':
+                self.write(cr, SUPERUSER_ID, rec.id, {'source_doc': rec.source_doc}, context=context)
+            elif rec.source_type == 'img':
+                self.write(cr, SUPERUSER_ID, rec.id, {'source_img': rec.source_img}, context=context)
+            else:
+                _logger.error('rec id %d is missing `source_type`', rec.id)
+                return 0
+            return 1
+        except Exception:
+            _logger.exception('error processing %r' % rec.name)
+            return 0
+
+    def _regenerate_parallel(self, cr, ids, workers, batch_size, context=None, progress=None):
+        """
+        render `ids` in a pool of `workers` processes, `batch_size` pages at a time
+
+        the next batch is rendered while the current one is written, and link resolution
+        and all database work stays in this process; if the workers take longer than
+        `wiki_render_timeout` over a batch they are stopped, and the pages not yet
+        written are rendered here instead
+        """
+        _logger.info('wiki: rendering %d pages with %d workers', len(ids), workers)
+        timeout = wiki_config('render_timeout', 600)
+        rebuilt = done = 0
+        pool = multiprocessing.Pool(workers, maxtasksperchild=batch_size*10)
+        try:
+            pending = None
+            for start in range(0, len(ids), batch_size):
+                records = self.browse(cr, SUPERUSER_ID, ids[start:start+batch_size], context=context)
+                jobs = [
+                        (r.id, r.name, r.source_type, r.source_doc if r.source_type == 'txt' else r.source_img)
+                        for r in records
+                        if r.source_type in ('txt', 'img')
+                        ]
+                result = pool.map_async(render_job, jobs, chunksize=max(1, len(jobs) // (workers * 4)))
+                if pending is not None:
+                    rebuilt += self._store_rendered(cr, *pending, timeout=timeout, context=context)
+                    done = start
+                    if progress is not None:
+                        progress(done)
+                pending = records, result
+            if pending is not None:
+                rebuilt += self._store_rendered(cr, *pending, timeout=timeout, context=context)
+                done = len(ids)
+            pool.close()
+        except multiprocessing.TimeoutError:
+            _logger.warning(
+                    'wiki: render workers took over %ss for a batch; rendering the remaining %d pages here',
+                    timeout, len(ids) - done,
+                    )
+        finally:
+            pool.terminate()
+            pool.join()
+        if done < len(ids):
+            if progress is not None:
+                serial_progress = lambda count: progress(done + count)
+            else:
+                serial_progress = None
+            rebuilt += self._regenerate_serial(cr, ids[done:], batch_size, context=context, progress=serial_progress)
+        return rebuilt
+
+    def _store_rendered(self, cr, records, result, timeout=None, context=None):
+        rendered = dict(result.get(timeout))
+        rebuilt = 0
+        for rec in records:
+            rebuilt += self._regenerate_page(cr, rec, rendered.get(rec.id), context=context)
+        return rebuilt
+
+    def _mark_stale(self, cr, ids, exclude=(), exclude_key=None):
+        """
+        mark the pages linking to `ids` -- other than those in `exclude`, or in wiki
+        key `exclude_key` -- as needing rendering again; returns how many were marked
+        """
+        if not ids:
+            return 0
+        query = [dedent('''
+                UPDATE %s SET stale = true
+                WHERE stale IS NOT TRUE
+                  AND id IN (SELECT src FROM wiki_links WHERE tgt IN %%s)
+                ''' % (self._table, ))]
+        params = [tuple(ids)]
+        if exclude:
+            query.append('AND id NOT IN %s')
+            params.append(tuple(exclude))
+        if exclude_key is not None:
+            query.append('AND wiki_key != %s')
+            params.append(exclude_key)
+        cr.execute(' '.join(query), params)
+        return cr.rowcount
+
+    def _refresh_stale(self, cr, ids=None, limit=None, context=None):
+        """
+        render the stale pages among `ids` (or any `limit` stale pages) again; returns
+        how many were rendered
+
+        pages another transaction is already rendering are left to it, and a page that
+        fails to render is logged and then left alone until it is saved again; see
+        `_render_links` for what is updated
+        """
+        where, params = ['stale'], []
+        if ids is not None:
+            if not ids:
+                return 0
+            where.append('id IN %s')
+            params.append(tuple(ids))
+        cr.execute(dedent('''
+                UPDATE %s SET stale = false
+                WHERE id IN (
+                    SELECT id FROM %s WHERE %s ORDER BY id %s FOR UPDATE SKIP LOCKED
+                    )
+                RETURNING id
+                ''' % (self._table, self._table, ' AND '.join(where), 'LIMIT %d' % limit if limit else '')),
+                params,
+                )
+        stale_ids = sorted(r[0] for r in cr.fetchall())
+        if not stale_ids:
+            return 0
+        with wiki_stats.phase('render.stale'):
+            return self._render_links(cr, stale_ids, context=context)
+
+    def _render_links(self, cr, ids, context=None):
+        """
+        render the text pages `ids` again, for links whose targets have changed
+
+        only `wiki_doc`, the links, the fingerprints, and the files are updated, and
+        directly rather than through `write`, so the pages keep their audit fields;
+        returns how many were rendered
+        """
+        cr.execute(
+                "SELECT id, name, name_key, wiki_key, source_doc FROM %s WHERE id IN %%s AND source_type = 'txt'"
+                % (self._table, ),
+                (tuple(ids), ),
+                )
+        rendered = 0
+        linked = set()
+        for id, name, page_key, wiki_key, source_doc in cr.fetchall():
+            try:
+                document = self._text2html(name, source_doc or '')
+            except Exception:
+                _logger.exception('wiki: unable to render %r', name)
+                continue
+            document, file_body, forward_links = self._convert_links(
+                    cr, SUPERUSER_ID, id, document, category=wiki_key, context=context,
+                    )
+            cr.execute(
+                    'UPDATE %s SET wiki_doc=%%s WHERE id=%%s' % (self._table, ),
+                    (wiki_document(document), id),
+                    )
+            cr.execute('DELETE FROM wiki_links WHERE src=%s RETURNING tgt', (id, ))
+            linked.update(r[0] for r in cr.fetchall())
+            targets = sorted(set(forward_links))
+            if targets:
+                cr.execute(
+                        'INSERT INTO wiki_links (src, tgt) VALUES %s' % ', '.join(['(%s, %s)'] * len(targets)),
+                        [i for tgt in targets for i in (id, tgt)],
+                        )
+            linked.update(targets)
+            self._write_html_file(cr, wiki_key, page_key, name, file_document(name, file_body))
+            rendered += 1
+        self._release_stubs(cr, linked)
+        self._update_fingerprints(cr, ids)
+        self._invalidate_links(cr)
+        return rendered
+
+    def refresh_stale(self, cr, uid, limit=500, context=None):
+        """
+        render up to `limit` stale pages again, so the on-disk mirror catches up
+        with pages nobody has read since they went stale (run by a scheduled action)
+
+        images still pending -- saved by a process whose workers have since stopped,
+        say -- are handed to this process's workers, or with `wiki_image_workers`
+        at 0 up to `limit` of them are processed here
+        """
+        if uid != SUPERUSER_ID:
+            raise ERPError('Wiki Error', 'only the administrator can render stale pages')
+        rendered = self._refresh_stale(cr, limit=limit, context=context)
+        if rendered:
+            _logger.info('wiki: %s -- %d stale pages rendered again', self._name, rendered)
+        cr.execute("SELECT count(*) FROM %s WHERE img_state='pending'" % (self._table, ))
+        if cr.fetchone()[0]:
+            if wiki_config('image_workers', 2) > 0:
+                image_queue.notify(cr.dbname, self._name)
+            else:
+                for _ in range(limit):
+                    if not self._process_pending_image(cr):
+                        break
+        return rendered
+
+    def _init_search(self, cr):
+        """
+        create the full-text index (and, if pg_trgm is available, the trigram index on
+        names), and fill in any pages that are not indexed yet
+        """
+        cr.execute(
+                "SELECT 1 FROM information_schema.columns WHERE table_name=%s AND column_name='search_vector'",
+                (self._table, ),
+                )
+        if not cr.fetchone():
+            cr.execute('ALTER TABLE %s ADD COLUMN search_vector tsvector' % (self._table, ))
+        cr.execute(
+                'CREATE INDEX IF NOT EXISTS %s_search_vector_idx ON %s USING gin (search_vector)'
+                % (self._table, self._table)
+                )
+        cr.execute('SAVEPOINT wiki_trigram')
+        try:
+            cr.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            cr.execute(
+                    'CREATE INDEX IF NOT EXISTS %s_name_trgm_idx ON %s USING gin (name gin_trgm_ops)'
+                    % (self._table, self._table)
+                    )
+            cr.execute('RELEASE SAVEPOINT wiki_trigram')
+            self._trigram = True
+        except Exception:
+            cr.execute('ROLLBACK TO SAVEPOINT wiki_trigram')
+            _logger.warning('wiki: pg_trgm is not available; page names will not be trigram indexed')
+            self._trigram = False
+        cr.execute('SELECT id FROM %s WHERE search_vector IS NULL' % (self._table, ))
+        ids = [r[0] for r in cr.fetchall()]
+        if ids:
+            self._update_search_vector(cr, ids)
+            _logger.info('wiki: %s -- indexed %d pages for searching', self._name, len(ids))
+
+    def _update_search_vector(self, cr, ids):
+        cr.execute(dedent('''
+                UPDATE %s
+                SET search_vector =
+                        setweight(to_tsvector(%%(config)s::regconfig, coalesce(name, '')), 'A')
+                     || setweight(to_tsvector(%%(config)s::regconfig, coalesce(source_doc, '')), 'B')
+                WHERE id IN %%(ids)s
+                ''' % (self._table, )),
+                {'config': wiki_config('search_config', 'english'), 'ids': tuple(ids)},
+                )
+
+    def search_text(self, cr, uid, query, wiki_key=None, limit=20, offset=0, context=None):
+        """
+        pages matching `query`, best first
+
+        returns a list of {'id', 'name', 'wiki_key', 'rank', 'snippet'} dicts, where
+        `snippet` is an html fragment with the matching words in <b>
+        """
+        config = wiki_config('search_config', 'english')
+        params = {'config': config, 'query': query, 'limit': limit, 'offset': offset, 'key': wiki_key}
+        if getattr(self, '_trigram', False):
+            name_match = 'OR p.name %% %(query)s'
+            name_rank = ' + similarity(p.name, %(query)s)'
+        else:
+            name_match = name_rank = ''
+        cr.execute(dedent('''
+                SELECT m.id, m.name, m.wiki_key, m.rank,
+                       ts_headline(
+                            %%(config)s::regconfig, coalesce(m.source_doc, ''), q,
+                            'StartSel=<b>, StopSel=</b>, MaxFragments=2'
+                            ) AS snippet
+                FROM (
+                    SELECT p.id, p.name, p.wiki_key, p.source_doc, q,
+                           ts_rank_cd(p.search_vector, q)%s AS rank
+                    FROM %s p, plainto_tsquery(%%(config)s::regconfig, %%(query)s) q
+                    WHERE (p.search_vector @@ q %s)
+                      AND (%%(key)s IS NULL OR p.wiki_key = %%(key)s)
+                    ORDER BY rank DESC, p.name
+                    LIMIT %%(limit)s OFFSET %%(offset)s
+                    ) m
+                ORDER BY m.rank DESC, m.name
+                ''' % (name_rank, self._table, name_match)),
+                params,
+                )
+        return cr.dictfetchall()
+
+    def _text_match_ids(self, cr, query):
+        "ids of every page `search_text` would find for `query`"
+        if getattr(self, '_trigram', False):
+            name_match = 'OR p.name %% %(query)s'
+        else:
+            name_match = ''
+        cr.execute(dedent('''
+                SELECT p.id
+                FROM %s p, plainto_tsquery(%%(config)s::regconfig, %%(query)s) q
+                WHERE p.search_vector @@ q %s
+                ''' % (self._table, name_match)),
+                {'config': wiki_config('search_config', 'english'), 'query': query},
+                )
+        return [r[0] for r in cr.fetchall()]
+
+    def _migrate_images(self, cr, batch_size=100):
+        """
+        move images stored in the table (from before the blob store) into the blob
+        store, leaving their digests
+        """
+        blob_store.init(cr)
+        cr.execute(
+                'SELECT column_name FROM information_schema.columns WHERE table_name=%s',
+                (self._table, ),
+                )
+        columns = set(r[0] for r in cr.fetchall())
+        if not set(['source_img', 'wiki_img']).issubset(columns):
+            return
+        for digest in ('source_img_digest', 'wiki_img_digest'):
+            if digest not in columns:
+                cr.execute('ALTER TABLE %s ADD COLUMN %s varchar(40)' % (self._table, digest))
+        migrated = 0
+        while True:
+            cr.execute(dedent('''
+                    SELECT id, source_img, wiki_img FROM %s
+                    WHERE source_img IS NOT NULL OR wiki_img IS NOT NULL
+                    ORDER BY id
+                    LIMIT %%s
+                    ''' % (self._table, )), (batch_size, ))
+            rows = cr.fetchall()
+            if not rows:
+                break
+            for id, source_img, wiki_img in rows:
+                digests = [
+                        image and blob_store.put(cr, b64decode(str(image))) or None
+                        for image in (source_img, wiki_img)
+                        ]
+                cr.execute(dedent('''
+                        UPDATE %s
+                        SET source_img_digest=%%s, wiki_img_digest=%%s, source_img=NULL, wiki_img=NULL
+                        WHERE id=%%s
+                        ''' % (self._table, )), digests + [id])
+            migrated += len(rows)
+        if migrated:
+            _logger.info('wiki: %s -- moved the images of %d pages to the blob store', self._name, migrated)
+
+    def _process_pending_image(self, cr):
+        """
+        build `wiki_img` and the on-disk files for one pending image
+
+        returns False if nothing was pending
+        """
+        cr.execute(dedent('''
+                SELECT id, img_queued FROM %s
+                WHERE img_state = 'pending'
+                ORDER BY img_queued
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+                ''' % (self._table, )))
+        row = cr.fetchone()
+        if row is None:
+            return False
+        id, queued = row
+        rec = self.browse(cr, SUPERUSER_ID, id)
+        context = {'wiki-maintenance': True}
+        try:
+            with wiki_stats.phase('images.resize'):
+                wiki_img = resize_image(rec.name, rec.source_img)
+        except Exception:
+            _logger.exception('wiki: unable to process image %r', rec.name)
+            self.write(cr, SUPERUSER_ID, [id], {'img_state': 'failed'}, context=context)
+            image_queue.record(None, failed=True)
+            return True
+        self.write(cr, SUPERUSER_ID, [id], {'wiki_img': wiki_img, 'img_state': 'done'}, context=context)
+        self._write_image_file(cr, rec.wiki_key, rec.name_key, rec.source_img_digest, image_digest(wiki_img))
+        latency = 0.0
+        if queued is not None:
+            if not isinstance(queued, datetime):
+                queued = datetime.strptime(queued[:19], DEFAULT_SERVER_DATETIME_FORMAT)
+            latency = max(0.0, (datetime.utcnow() - queued).total_seconds())
+        image_queue.record(latency)
+        return True
+
+    def image_queue_status(self, cr, uid, context=None):
+        """
+        pending image count, age of the oldest, and this server process' worker statistics
+        """
+        cr.execute(dedent('''
+                SELECT count(*), extract(epoch FROM (now() at time zone 'UTC') - min(img_queued))
+                FROM %s
+                WHERE img_state = 'pending'
+                ''' % (self._table, )))
+        pending, oldest = cr.fetchone()
+        res = image_queue.stats()
+        res['pending'] = pending
+        res['oldest_pending'] = oldest or 0.0
         return res
 
-    def _write_html_file(self, cr, uid, id, context=None):
-        if not isinstance(id, (int, long)):
-            [id] = id
-        def repl(mo):
-            href, target, close = mo.groups()
-            if target.startswith(('http','#footnote-')):
-                return href + target + close
-            key = self.name_key(target)
-            return "%s%s.html%s" % (href, key, close)
-        rec = self.browse(cr, uid, id, context=context)
-        name = rec.name
-        title = '%s\n%s\n%s\n\n' % (len(name)*'=', name, len(name)*'=')
-        source_doc = title + (rec.source_doc or '')
-        document = Document(source_doc, first_header_is_title=True).to_html()
-        link = re.compile('(<a href=")([^"]*)(">)')
-        document = re.sub(link, repl, document)
-        file = self._wiki_path/name_key(rec.wiki_key)/rec.name_key + '.html'
-        write_html_file(file, document, title)
-        css_file = self._wiki_path/name_key(rec.wiki_key)/'stonemark.css'
-        if not css_file.exists():
-            write_css(self._wiki_path/name_key(rec.wiki_key)/'stonemark.css')
-
-    def _write_image_file(self, cr, uid, id, context=None):
-        if not isinstance(id, (int, long)):
-            [id] = id
-        rec = self.browse(cr, uid, id, context=context)
-        file = self._wiki_path/name_key(rec.wiki_key)/rec.name_key
-        with open(file, 'w') as fh:
-            fh.write(b64decode(rec.source_img))
+    def _fingerprint_rows(self, cr, ids):
+        """
+        yield (id, name, name_key, source_type, stored fingerprint, current fingerprint) for
+        each record in `ids`
+
+        the sources are digested by the database, so the binary columns never leave it
+        """
+        if not ids:
+            return
+        version = renderer_version()
+        cr.execute(dedent('''
+                SELECT p.id, p.name, p.name_key, p.source_type, p.fingerprint,
+                       md5(p.source_doc), p.source_img_digest,
+                       (SELECT string_agg(t.id || ':' || t.name_key, ',' ORDER BY t.id)
+                          FROM wiki_links l JOIN %s t ON t.id = l.tgt
+                         WHERE l.src = p.id)
+                FROM %s p
+                WHERE p.id IN %%s
+                ''' % (self._table, self._table)), (tuple(ids), )
+                )
+        for id, name, key, source_type, stored, doc_digest, img_digest, targets in cr.fetchall():
+            current = sha1('\0'.join([
+                    version, self._name, name, source_type or '',
+                    doc_digest or '', img_digest or '', targets or '',
+                    ]).encode('utf-8')).hexdigest()
+            yield id, name, key, source_type, stored, current
+
+    def _update_fingerprints(self, cr, ids):
+        for row in list(self._fingerprint_rows(cr, ids)):
+            id, stored, current = row[0], row[-2], row[-1]
+            if stored != current:
+                cr.execute(
+                        'UPDATE %s SET fingerprint=%%s WHERE id=%%s' % (self._table, ),
+                        (current, id),
+                        )
+
+    def _write_html_file(self, cr, wiki_key, page_key, name, document):
+        """
+        write `document` (with file links) to the on-disk mirror of `wiki_key` once
+        `cr` commits
+        """
+        with wiki_stats.phase('files.html'):
+            wiki_path = self._wiki_path/name_key(wiki_key)
+            file_writer.write(cr, wiki_path/page_key + '.html', html_file(escape(name), document))
+            file_writer.ensure_css(cr, wiki_path)
+
+    def _write_image_file(self, cr, wiki_key, page_key, source_digest, wiki_digest=None):
+        """
+        link the source image, and the wiki-sized rendition, from the blob store into
+        the on-disk mirror of `wiki_key` once `cr` commits
+        """
+        with wiki_stats.phase('files.image'):
+            # other renditions are out of date, and are recreated when next requested
+            for file in self._page_files(wiki_key, page_key, 'img'):
+                file_writer.delete(cr, file)
+            images = [(None, source_digest)]
+            if wiki_digest:
+                images.append((IMAGE_WIDTH, wiki_digest))
+            for width, digest in images:
+                file_writer.link(cr, image_path(self._wiki_path, wiki_key, page_key, width), blob_store.file(digest))
+
+    def _page_files(self, wiki_key, page_key, source_type):
+        """
+        all the on-disk files of a page -- its document, or its image and renditions
+        """
+        if source_type == 'txt':
+            return [self._wiki_path/name_key(wiki_key)/page_key + '.html']
+        files = [image_path(self._wiki_path, wiki_key, page_key)]
+        renditions = self._wiki_path/name_key(wiki_key)/'.renditions'
+        if renditions.exists():
+            files.extend(renditions/width/page_key for width in renditions.listdir())
+        return [f for f in files if f.exists()]
 
     def _convert_links(self, cr, uid, id, document, category, context=None):
+        """
+        replace page and image links in `document` with links to their records
+
+        all targets are collected first and resolved together; any that do not exist
+        are created as empty pages or placeholder images
+
+        returns the document with `#id=` links (for `wiki_doc`), the document with
+        file links (for the on-disk mirror), and the ids linked to
+        """
         if not isinstance(id, (int, long)):
             [id] = id
         context = (context or {}).copy()
         context['wiki_reverse_link'] = id
+        # first pass: collect the targets
+        pages = {}
+        images = {}
+        for mo in _any_link.finditer(document):
+            if mo.group(1):
+                target, targets = mo.group(2), pages
+            else:
+                target, targets = mo.group(5), images
+            if is_local_link(target):
+                targets.setdefault(self.name_key(target), target.strip())
+        with wiki_stats.phase('links.resolve'):
+            target_ids = self._resolve_targets(cr, uid, pages, images, category, context=context)
+        # second pass: build both documents
         forward_links = []
-        def repl_image_link(mo):
-            src, target, attrs, close = mo.groups()
-            if target.startswith('http'):
-                return src + target + attrs + close
+        wiki_doc = []
+        file_doc = []
+        last = 0
+        for mo in _any_link.finditer(document):
+            text = document[last:mo.start()]
+            wiki_doc.append(text)
+            file_doc.append(text)
+            last = mo.end()
+            target = mo.group(2) if mo.group(1) else mo.group(5)
+            if not is_local_link(target):
+                wiki_doc.append(mo.group(0))
+                file_doc.append(mo.group(0))
+                continue
             key = self.name_key(target)
-            target_ids = self.search(cr, uid, [('name_key','=',key)], context=context)
-            if not target_ids:
-                # create empty image
-                target_ids = [self.create(
-                        cr, uid,
-                        values={
-                            'name': target,
-                            'source_type': 'img',
-                            'source_img': placeholder,
-                            'wiki_key': category,
-                            },
-                        context=context,
-                        )]
-            forward_links.extend(target_ids)
-            return '<a href="#id=%d">%s/wiki/image?model=%s&img_id=%d%s%s</a>' % (
-                    target_ids[0],
-                    src,
-                    self._name,
-                    target_ids[0],
-                    attrs,
-                    close,
+            target_id, target_category = target_ids[key]
+            forward_links.append(target_id)
+            if target_category != category:
+                key = '../%s/%s' % (name_key(target_category), key)
+            if mo.group(1):
+                href, target, close = mo.group(1, 2, 3)
+                wiki_doc.append("%s#id=%d%s" % (href, target_id, close))
+                file_doc.append("%s%s.html%s" % (href, key, close))
+            else:
+                src, target, attrs, close = mo.group(4, 5, 6, 7)
+                url = '/wiki/image?model=%s&img_id=%d' % (self._name, target_id)
+                wiki_doc.append('<a href="#id=%d">%s%s%s %s%s</a>' % (
+                        target_id,
+                        src,
+                        url,
+                        attrs,
+                        image_srcset(url),
+                        close,
+                        ))
+                file_doc.append('%s%s%s%s' % (src, key, attrs, close))
+        text = document[last:]
+        wiki_doc.append(text)
+        file_doc.append(text)
+        return ''.join(wiki_doc), ''.join(file_doc), forward_links
+
+    def _resolve_targets(self, cr, uid, pages, images, category, context=None):
+        """
+        return {name_key: (id, wiki_key)} for all the keys in `pages` and `images`,
+        creating any that are missing
+
+        `pages` and `images` are {name_key: name}; a key linked to as both a page
+        and an image is created as a page
+        """
+        keys = set(pages) | set(images)
+        if not keys:
+            return {}
+        cr.execute(
+                'SELECT name_key, id, wiki_key FROM %s WHERE name_key IN %%s' % (self._table, ),
+                (tuple(keys), ),
+                )
+        target_ids = dict((key, (id, category)) for key, id, category in cr.fetchall())
+        missing_pages = [(k, n) for k, n in pages.items() if k not in target_ids]
+        missing_images = [(k, n) for k, n in images.items() if k not in target_ids and k not in pages]
+        if missing_pages or missing_images:
+            with wiki_stats.phase('links.stubs'):
+                target_ids.update(self._create_stubs(
+                        cr, uid, missing_pages, missing_images, category, context=context,
+                        ))
+        return target_ids
+
+    def _create_stubs(self, cr, uid, pages, images, category, context=None):
+        """
+        create empty pages and placeholder images for the (name_key, name) pairs in
+        `pages` and `images`; returns {name_key: (id, category)}
+        """
+        empty_image = None
+        if images:
+            # both columns of every placeholder refer to the same blob
+            empty_image = blob_store.put(cr, b64decode(placeholder), refs=2 * len(images))
+        rows = [
+                {
+                    'name': name, 'name_key': key, 'wiki_key': category,
+                    'source_type': 'txt', 'source_doc': '[[under construction]]',
+                    'is_empty': True, 'is_stub': True,
+                    }
+                for key, name in pages
+                ] + [
+                {
+                    'name': name, 'name_key': key, 'wiki_key': category,
+                    'source_type': 'img', 'source_img_digest': empty_image, 'wiki_img_digest': empty_image,
+                    'is_empty': True, 'is_stub': True,
+                    }
+                for key, name in images
+                ]
+        ids = self._bulk_insert(cr, uid, rows, context=context)
+        page_ids = ids[:len(pages)]
+        image_ids = ids[len(pages):]
+        if page_ids:
+            # every stub has the same text, so render and link it once
+            document = self._text2html('[[under construction]]', '[[under construction]]')
+            document, file_body, forward_links = self._convert_links(
+                    cr, uid, page_ids[0], document, category, context=context,
                     )
-        def repl_page_link(mo):
-            href, target, close = mo.groups()
-            if target.startswith((
-                    'http',         # external link
-                    '#footnote-',   # footnote link
-                )):
-                return href + target + close
-            key = self.name_key(target)
-            target_ids = self.search(cr, uid, [('name_key','=',key)], context=context)
-            if not target_ids:
-                # create empty page
-                target_ids = [self.create(
-                        cr, uid,
-                        values={
-                            'name': target,
-                            'source_doc': '[[under construction]]',
-                            'wiki_key': category,
-                            },
-                        context=context,
-                        )]
-            forward_links.extend(target_ids)
-            return "%s#id=%d%s" % (href, target_ids[0], close)
-        web_link = re.compile('(<a href=")([^"]*)(">)')
-        img_link = re.compile('(<img src=")([^"]*)(")([^>]*>)')
-        document = re.sub(web_link, repl_page_link, document)
-        document = re.sub(img_link, repl_image_link, document)
-        return document, forward_links
+            cr.execute(
+                    'UPDATE %s SET wiki_doc=%%s WHERE id IN %%s' % (self._table, ),
+                    (wiki_document(document), tuple(page_ids)),
+                    )
+            links = [(src, tgt) for src in page_ids for tgt in set(forward_links)]
+            if links:
+                cr.execute(
+                        'INSERT INTO wiki_links (src, tgt) VALUES %s' % ', '.join(['(%s, %s)'] * len(links)),
+                        [i for link in links for i in link],
+                        )
+                self._release_stubs(cr, set(forward_links))
+            for key, name in pages:
+                self._write_html_file(cr, category, key, name, file_document(name, file_body))
+        for key, name in images:
+            self._write_image_file(cr, category, key, empty_image, empty_image)
+        self._update_fingerprints(cr, ids)
+        self._update_search_vector(cr, ids)
+        self._invalidate_links(cr)
+        return dict((row['name_key'], (id, category)) for row, id in zip(rows, ids))
+
+    def _bulk_insert(self, cr, uid, rows, context=None):
+        """
+        insert `rows` (a list of values dicts) with a single statement, bypassing
+        `create`; returns the new ids in the same order as `rows`
+
+        only stored, non-relational columns can be set; column defaults are applied
+        """
+        defaults = self.default_get(cr, uid, list(self._columns), context=context)
+        columns = set(defaults)
+        for row in rows:
+            columns.update(row)
+        columns = sorted(c for c in columns if self._columns[c]._classic_write)
+        symbols = [self._columns[c]._symbol_set for c in columns]
+        placeholders = [s[0] for s in symbols]
+        sql_columns = list(columns)
+        params = []
+        for row in rows:
+            values = defaults.copy()
+            values.update(row)
+            params.extend(f(values.get(c, False)) for c, (_, f) in zip(columns, symbols))
+            if self._log_access:
+                params.extend([uid, uid])
+        if self._log_access:
+            sql_columns.extend(['create_uid', 'write_uid', 'create_date', 'write_date'])
+            placeholders.extend(['%s', '%s', "(now() at time zone 'UTC')", "(now() at time zone 'UTC')"])
+        cr.execute(
+                'INSERT INTO %s (%s) VALUES %s RETURNING id' % (
+                    self._table,
+                    ', '.join('"%s"' % c for c in sql_columns),
+                    ', '.join(['(%s)' % ', '.join(placeholders)] * len(rows)),
+                    ),
+                params,
+                )
+        return [r[0] for r in cr.fetchall()]
 
     name_key = staticmethod(name_key)
 
     def _text2html(self, name, source_doc, context=None):
+        return text2html(name, source_doc)
+
+    def export_site(self, cr, uid, wiki_key, format='zip', since=None, context=None):
+        """
+        the on-disk mirror of `wiki_key` as an iterator of archive chunks; see
+        `export_site()` for `format` and `since`
+
+        `wiki_key` must be one of this wiki's keys
+        """
+        if wiki_key not in [k for k, _ in self._select_key(cr, uid, context=context)]:
+            raise ERPError('Wiki Error', 'unknown wiki key: %r' % (wiki_key, ))
         try:
-            return (
-                    '<div class="wiki">\n'
-                    + Document(source_doc).to_html()
-                    + '\n</div>'
+            key_directory(self._wiki_path, wiki_key)
+        except ValueError as exc:
+            raise ERPError('Wiki Error', str(exc))
+        cr.execute(dedent('''
+                SELECT name, name_key, source_type
+                FROM %s
+                WHERE wiki_key = %%s
+                ORDER BY top_level DESC NULLS LAST, name
+                ''' % (self._table, )),
+                (wiki_key, ),
+                )
+        return export_site(self._wiki_path, wiki_key, cr.fetchall(), format, since)
+
+    def import_pages(self, cr, uid, wiki_key, archive=None, path=None, context=None):
+        """
+        add the stonemark documents and images in `archive` (a base64 encoded zip
+        archive) or, for the superuser only, in `path` (a directory tree or zip
+        archive on the server) to `wiki_key`
+
+        every row is inserted first, so links between the imported pages find their
+        targets instead of creating stubs; the pages are then rendered (in worker
+        processes if `wiki_render_workers` is set) and their links resolved.  Files
+        whose name is already in use are skipped.
+
+        returns a report: the counts of pages and images imported, of those rendered,
+        and of stubs created for links to pages that do not exist; the names
+        skipped; the (path, reason) of files that could not be imported; and the
+        seconds taken
+        """
+        started = time.time()
+        if (archive is None) == (path is None):
+            raise ERPError('Wiki Error', 'give either an archive or a path to import')
+        if path is not None and uid != SUPERUSER_ID:
+            raise ERPError('Wiki Error', 'only the administrator can import from the server')
+        # the rows are inserted directly, so check what create() would have
+        self.check_access_rights(cr, uid, 'create')
+        if wiki_key not in [k for k, _ in self._select_key(cr, uid, context=context)]:
+            raise ERPError('Wiki Error', 'unknown wiki key: %r' % (wiki_key, ))
+        source = path if path is not None else io.BytesIO(b64decode(archive))
+        report = {'pages': 0, 'images': 0, 'rendered': 0, 'stubs': 0, 'skipped': [], 'failed': []}
+        # which files become which pages
+        entries = []
+        seen = {}
+        for path, read in import_files(source):
+            found = import_name(path)
+            if found is None:
+                continue
+            name, source_type = found
+            key = name_key(name)
+            if not key or len(name) > self._columns['name'].size:
+                report['failed'].append((path, 'unusable name'))
+            elif key in seen:
+                report['failed'].append((path, 'same name as %s' % seen[key]))
+            else:
+                seen[key] = path
+                entries.append((name, key, source_type, path, read))
+        existing = set()
+        for start in range(0, len(entries), 1000):
+            keys = tuple(e[1] for e in entries[start:start+1000])
+            cr.execute('SELECT name_key FROM %s WHERE name_key IN %%s' % (self._table, ), (keys, ))
+            existing.update(r[0] for r in cr.fetchall())
+        cr.execute('SELECT count(*) FROM %s' % (self._table, ))
+        before = cr.fetchone()[0]
+        # first pass: the rows, without rendering
+        batch_size = wiki_config('render_batch', 200)
+        text_ids, image_ids, rows = [], [], []
+        for name, key, source_type, path, read in entries:
+            if key in existing:
+                report['skipped'].append(name)
+                continue
+            try:
+                data = read()
+                if source_type == 'txt':
+                    row = {'source_doc': data.decode('utf-8')}
+                else:
+                    check_image(name, b64encode(data))
+                    row = {'source_img_digest': blob_store.put(cr, data)}
+            except (ERPError, UnicodeDecodeError, IOError, OSError) as exc:
+                report['failed'].append((path, exc.args[-1] if exc.args else repr(exc)))
+                continue
+            row.update({'name': name, 'name_key': key, 'wiki_key': wiki_key, 'source_type': source_type})
+            rows.append(row)
+            if len(rows) == batch_size:
+                self._import_rows(cr, uid, rows, text_ids, image_ids, context=context)
+                rows = []
+        if rows:
+            self._import_rows(cr, uid, rows, text_ids, image_ids, context=context)
+        report['pages'], report['images'] = len(text_ids), len(image_ids)
+        _logger.info(
+                'wiki: %s -- %d pages and %d images inserted into %r; rendering',
+                self._name, len(text_ids), len(image_ids), wiki_key,
+                )
+        # second pass: render, and resolve links now that every target exists
+        ids = text_ids + image_ids
+        def progress(done):
+            _logger.info('wiki: %s -- %d of %d imported pages rendered', self._name, done, len(ids))
+        report['rendered'] = self._regenerate_ids(cr, ids, context=context, progress=progress)
+        if image_ids:
+            # write() only reindexes when the text changes
+            self._update_search_vector(cr, image_ids)
+        cr.execute('SELECT count(*) FROM %s' % (self._table, ))
+        report['stubs'] = cr.fetchone()[0] - before - len(ids)
+        report['seconds'] = round(time.time() - started, 3)
+        _logger.info(
+                'wiki: %s -- import into %r done: %d rendered, %d stubs, %d skipped, %d failed in %.1fs',
+                self._name, wiki_key, report['rendered'], report['stubs'],
+                len(report['skipped']), len(report['failed']), report['seconds'],
+                )
+        return report
+
+    def _import_rows(self, cr, uid, rows, text_ids, image_ids, context=None):
+        ids = self._bulk_insert(cr, uid, rows, context=context)
+        for row, id in zip(rows, ids):
+            (text_ids if row['source_type'] == 'txt' else image_ids).append(id)
+
+    def stats(self, cr, uid, context=None):
+        """
+        this server process' phase timings, and cache, file writer, and image
+        queue counters
+        """
+        return stats_report()
+
+    def render_cache_stats(self, cr, uid, context=None):
+        """
+        hit/miss counters of this server process' rendered-document cache
+        """
+        return render_cache.stats()
+
+    #-----------------------------------------------------------------------------------
+    # link graph: each report is one query over wiki_links, cached until the links
+    # change; every report is a list of {'id', 'name', 'wiki_key', ...} dicts, and
+    # `wiki_key` limits which pages are reported (links are followed across keys)
+
+    def _link_report(self, cr, report, query, **params):
+        graph = cr.dbname, self._table
+        key = (report, ) + tuple(sorted(params.items()))
+        rows = link_cache.get(graph, key)
+        if rows is None:
+            cr.execute(dedent(query % {'table': self._table}), params)
+            rows = cr.dictfetchall()
+            link_cache.set(graph, key, rows)
+        return [dict(row) for row in rows]
+
+    def _invalidate_links(self, cr):
+        link_cache.invalidate((cr.dbname, self._table))
+
+    def _release_stubs(self, cr, ids):
+        """
+        note when the stubs among `ids` lost their last link, and forget it for those
+        linked to again; `_collect_stubs` counts the grace period from then
+        """
+        if not ids:
+            return
+        cr.execute(dedent('''
+                UPDATE %s p
+                SET stub_released = CASE
+                        WHEN EXISTS (SELECT 1 FROM wiki_links l WHERE l.tgt = p.id AND l.src != p.id)
+                        THEN NULL
+                        ELSE coalesce(p.stub_released, now() at time zone 'UTC')
+                        END
+                WHERE p.is_stub AND p.id IN %%s
+                ''' % (self._table, )), (tuple(ids), ))
+
+    def orphan_pages(self, cr, uid, wiki_key=None, context=None):
+        """
+        pages that are not top level and that no other page links to
+        """
+        return self._link_report(cr, 'orphans', '''
+                SELECT p.id, p.name, p.wiki_key
+                FROM %(table)s p
+                WHERE NOT coalesce(p.top_level, false)
+                  AND NOT EXISTS (SELECT 1 FROM wiki_links l WHERE l.tgt = p.id AND l.src != p.id)
+                  AND (%%(key)s IS NULL OR p.wiki_key = %%(key)s)
+                ORDER BY p.wiki_key, p.name
+                ''', key=wiki_key)
+
+    def stub_pages(self, cr, uid, wiki_key=None, context=None):
+        """
+        text pages that are still empty (e.g. [[under construction]]), with the ids of
+        the pages linking to them in `referenced_by`
+        """
+        rows = self._link_report(cr, 'stubs', '''
+                SELECT p.id, p.name, p.wiki_key, array_agg(l.src ORDER BY l.src) AS referenced_by
+                FROM %(table)s p
+                LEFT JOIN wiki_links l ON l.tgt = p.id
+                WHERE p.source_type = 'txt' AND p.is_empty
+                  AND (%%(key)s IS NULL OR p.wiki_key = %%(key)s)
+                GROUP BY p.id, p.name, p.wiki_key
+                ORDER BY p.wiki_key, p.name
+                ''', key=wiki_key)
+        for row in rows:
+            # an unreferenced stub aggregates to [None]
+            row['referenced_by'] = [id for id in row['referenced_by'] if id is not None]
+        return rows
+
+    def unreachable_pages(self, cr, uid, wiki_key=None, context=None):
+        """
+        pages that cannot be reached by following links from any top-level page
+        """
+        return self._link_report(cr, 'unreachable', '''
+                WITH RECURSIVE reachable(id) AS (
+                        SELECT id FROM %(table)s WHERE top_level
+                    UNION
+                        SELECT l.tgt FROM reachable r JOIN wiki_links l ON l.src = r.id
                     )
-        except Exception:
-            _logger.exception('stonemark unable to convert document <%s>', name)
-            return '<pre>' + escape(source_doc) + '</pre>'
+                SELECT p.id, p.name, p.wiki_key
+                FROM %(table)s p
+                WHERE NOT EXISTS (SELECT 1 FROM reachable r WHERE r.id = p.id)
+                  AND (%%(key)s IS NULL OR p.wiki_key = %%(key)s)
+                ORDER BY p.wiki_key, p.name
+                ''', key=wiki_key)
+
+    def most_linked_pages(self, cr, uid, limit=10, wiki_key=None, context=None):
+        """
+        the `limit` pages with the most other pages linking to them, with that number
+        in `links`
+        """
+        return self._link_report(cr, 'most_linked', '''
+                SELECT p.id, p.name, p.wiki_key, count(*) AS links
+                FROM wiki_links l
+                JOIN %(table)s p ON p.id = l.tgt
+                WHERE l.src != l.tgt
+                  AND (%%(key)s IS NULL OR p.wiki_key = %%(key)s)
+                GROUP BY p.id, p.name, p.wiki_key
+                ORDER BY links DESC, p.name
+                LIMIT %%(limit)s
+                ''', key=wiki_key, limit=limit)
+
+    def collect_garbage(self, cr, uid, dry_run=False, grace=None, context=None):
+        """
+        remove the stub pages and placeholder images nothing links to any more, from
+        every wiki, along with their files; then purge the unreferenced image blobs
+
+        only pages `_create_stubs` made, and nobody has filled in since, are removed;
+        as that is done directly in the database, only the superuser may do it
+
+        only what nothing has linked to for `grace` seconds (default: the `wiki_gc_grace`
+        option) is removed; with `dry_run` nothing is, and the report says what would be
+
+        returns {'pages': {model: [{'id', 'name', 'wiki_key', 'source_type'}]},
+                 'blobs': count, 'blob_bytes': total size}
+        """
+        if uid != SUPERUSER_ID:
+            raise ERPError('Wiki Error', 'only the administrator can collect garbage')
+        if grace is None:
+            grace = wiki_config('gc_grace', 7 * 24 * 3600)
+        report = {'pages': {}}
+        for model in ['wiki.page'] + sorted(self._wiki_tables):
+            pages = self.pool.get(model)
+            removed = pages._collect_stubs(cr, grace, dry_run)
+            if removed:
+                report['pages'][model] = removed
+        blobs = blob_store.purge(cr, grace, dry_run=dry_run)
+        report['blobs'] = len(blobs)
+        report['blob_bytes'] = sum(size for digest, size in blobs)
+        _logger.info(
+                'wiki: garbage collection%s -- %d stub pages, %d blobs (%d bytes)',
+                ' (dry run)' if dry_run else '',
+                sum(len(p) for p in report['pages'].values()),
+                report['blobs'],
+                report['blob_bytes'],
+                )
+        return report
+
+    def _collect_stubs(self, cr, grace, dry_run):
+        cr.execute(dedent('''
+                SELECT p.id, p.name, p.name_key, p.wiki_key, p.source_type,
+                       p.source_img_digest, p.wiki_img_digest
+                FROM %s p
+                WHERE p.is_stub
+                  AND p.is_empty
+                  AND NOT coalesce(p.top_level, false)
+                  AND p.stub_released < (now() at time zone 'UTC') - interval '1 second' * %%s
+                  AND NOT EXISTS (SELECT 1 FROM wiki_links l WHERE l.tgt = p.id AND l.src != p.id)
+                ORDER BY p.wiki_key, p.name
+                %s
+                ''' % (self._table, '' if dry_run else 'FOR UPDATE SKIP LOCKED')),
+                (grace, ),
+                )
+        rows = cr.dictfetchall()
+        removed = [dict((k, r[k]) for k in ('id', 'name', 'wiki_key', 'source_type')) for r in rows]
+        if not rows or dry_run:
+            return removed
+        ids = tuple(r['id'] for r in rows)
+        cr.execute('DELETE FROM wiki_links WHERE src IN %s OR tgt IN %s RETURNING tgt', (ids, ids))
+        # what these stubs linked to may be an unlinked stub itself now
+        linked = set(r[0] for r in cr.fetchall()) - set(ids)
+        cr.execute('DELETE FROM %s WHERE id IN %%s' % (self._table, ), (ids, ))
+        self._release_stubs(cr, linked)
+        blob_store.release(cr, [
+                digest
+                for r in rows
+                for digest in (r['source_img_digest'], r['wiki_img_digest'])
+                if digest
+                ])
+        for r in rows:
+            for file in self._page_files(r['wiki_key'], r['name_key'], r['source_type']):
+                file_writer.delete(cr, file)
+        self._invalidate_links(cr)
+        return removed
+
+    def link_cache_stats(self, cr, uid, context=None):
+        """
+        hit/miss counters of this server process' link-graph report cache
+        """
+        return link_cache.stats()
 
     #-----------------------------------------------------------------------------------
     # create: parse links, maybe create empty linked pages
@@ -469,88 +2881,166 @@ class wiki_doc(osv.Model):
         # replace page_name links in wiki_doc with ids of linked records
         if context is None:
             context = {}
+        if context.get('wiki_profile'):
+            context = dict(context, wiki_profile=False)
+            return profiled('%s.create' % self._name, self.create, cr, uid, values, context=context)
         name = values['name'] = values['name'].strip()
         values['name_key'] = name_key(name)
         new_id = super(wiki_doc, self).create(cr, uid, values, context=context)
         del values['name']
         del values['name_key']
         self.write(cr, uid, [new_id], values, context=context)
+        # name is not among the values written
+        self._update_search_vector(cr, [new_id])
         return new_id
 
+    def read(self, cr, uid, ids, fields=None, context=None, load='_classic_read'):
+        check_ids = [ids] if isinstance(ids, (int, long)) else ids
+        if check_ids and (fields is None or 'wiki_doc' in fields):
+            # bring pages whose links went stale up to date first; a plain look,
+            # without locks, is enough to know whether there are any
+            cr.execute(
+                    'SELECT id FROM %s WHERE id IN %%s AND stale' % (self._table, ),
+                    (tuple(check_ids), ),
+                    )
+            stale_ids = [r[0] for r in cr.fetchall()]
+            if stale_ids:
+                self._refresh_stale(cr, stale_ids, context=context)
+        return super(wiki_doc, self).read(cr, uid, ids, fields, context=context, load=load)
+
     def write(self, cr, uid, ids, values, context=None):
-        # TODO: handle changes to wiki_key
         context = context or {}
         if isinstance(ids, (int, long)):
             ids = [ids]
         if context.get('wiki-maintenance'):
+            if set(['wiki_key', 'forward_links']).intersection(values):
+                self._invalidate_links(cr)
             return super(wiki_doc, self).write(cr, uid, ids, values, context=context)
+        if context.get('wiki_profile'):
+            context = dict(context, wiki_profile=False)
+            return profiled('%s.write' % self._name, self.write, cr, uid, ids, values, context=context)
+        with wiki_stats.operation('write', model=self._name, ids=len(ids), fields=sorted(values)):
+            return self._write_pages(cr, uid, ids, values, context)
+
+    def _write_pages(self, cr, uid, ids, values, context):
+        rendered = context.get('wiki_rendered', {})
+        pending = []
+        moved = []
+        linked = set()
         for rec in self.browse(cr, uid, ids, context=context):
-            old_file = None
-            if 'name' in values:
-                # save old name so old file can be deleted
-                old_file = self._wiki_path / name_key(rec.wiki_key) / rec.name_key
-                if rec.source_type == 'txt':
-                    old_file += '.html'
-                name = values['name'] = values['name'].strip()
+            vals = values.copy()
+            old_files = []
+            if 'name' in vals:
+                # save old name so old files can be deleted
+                old_files = self._page_files(rec.wiki_key, rec.name_key, rec.source_type)
+                name = vals['name'] = vals['name'].strip()
                 new_name_key = self.name_key(name)
                 if rec.name_key != new_name_key and rec.reverse_links:
                     # do not allow name changes as it would require automatically updating the
                     # linking documents' text with the new name
                     raise ERPError('invalid name change', 'document is linked to, and change would modify name key')
-                values['name_key'] = new_name_key
-            if 'source_type' in values:
-                st = values['source_type']
+                vals['name_key'] = new_name_key
+                if name != rec.name:
+                    moved.append(rec.id)
+            if vals.get('wiki_key', rec.wiki_key) != rec.wiki_key:
+                # the files move to the new key's directory
+                old_files = old_files or self._page_files(rec.wiki_key, rec.name_key, rec.source_type)
+                moved.append(rec.id)
+            if 'source_type' in vals:
+                st = vals['source_type']
                 if st == 'txt':
-                    values['source_img'] = False
-                    values['wiki_img'] = False
+                    vals['source_img'] = False
+                    vals['wiki_img'] = False
                 else:  # 'img'
-                    values['source_doc'] = False
-                    values['wiki_doc'] = False
-                    values['forward_links'] = [(5, False)]
-            wiki_key = values.get('wiki_key', rec.wiki_key)
-            source_doc = values.get('source_doc')
-            source_img = values.get('source_img')
-            if source_doc:
-                name = values.get('name', rec.name)
-                document = self._text2html(name, source_doc)
-                document, forward_links = self._convert_links(
-                        cr, uid, rec.id,
-                        document,
-                        category=wiki_key,
-                        context=context,
-                        )
-                values['wiki_doc'] = document
+                    vals['source_doc'] = False
+                    vals['wiki_doc'] = False
+                    vals['forward_links'] = [(5, False)]
+            name = vals.get('name', rec.name)
+            wiki_key = vals.get('wiki_key', rec.wiki_key)
+            page_key = vals.get('name_key', rec.name_key)
+            source_type = vals.get('source_type', rec.source_type)
+            if rec.is_stub and (
+                    ('source_doc' in vals and vals['source_doc'] != rec.source_doc)
+                    or ('source_img' in vals and image_digest(vals['source_img']) != rec.source_img_digest)
+                ):
+                # someone's page now, even if emptied again
+                vals['is_stub'] = False
+            # only changes to these affect what is rendered
+            changed = set(['name', 'wiki_key', 'source_type', 'source_doc', 'source_img']).intersection(vals)
+            file_doc = source_img = None
+            if source_type == 'txt' and changed:
+                source_doc = vals['source_doc'] if 'source_doc' in vals else rec.source_doc
+                with wiki_stats.phase('write.render'):
+                    document = rendered.get(rec.id) or self._text2html(name, source_doc or '')
+                with wiki_stats.phase('write.links'):
+                    document, file_body, forward_links = self._convert_links(
+                            cr, uid, rec.id,
+                            document,
+                            category=wiki_key,
+                            context=context,
+                            )
+                vals['wiki_doc'] = wiki_document(document)
+                vals['stale'] = False
+                file_doc = file_document(name, file_body)
                 if forward_links:
-                    values['forward_links'] = [(6, 0, list(set(forward_links)))]
+                    vals['forward_links'] = [(6, 0, list(set(forward_links)))]
                 else:
-                    values['forward_links'] = [(5, False)]
-            if source_img:
-                name = values.get('name', rec.name)
-                values['wiki_img'] = values['source_img']
-                file_type = os.path.splitext(name)[1][1:]  # strip leading period
-                image_stream = io.BytesIO(b64decode(values['source_img']))
-                image = Image.open(image_stream)
-                target_width = 900
-                if target_width < image.size[0]:
-                    target_height = int(image.size[1] * (float(target_width) / image.size[0]))
-                    size = target_width, target_height
-                    image = ImageOps.fit(image, size, Image.ANTIALIAS)
-                    if image.mode not in ["1", "L", "P", "RGB", "RGBA"]:
-                        image = image.convert("RGB")
-                    new_image_stream = io.BytesIO()
-                    image.save(new_image_stream, file_type)
-                    values['wiki_img'] = b64encode(new_image_stream.getvalue())
-            if not super(wiki_doc, self).write(cr, uid, ids, values, context=context):
-                return False
-            try:
-                old_file and old_file.unlink()
-            except Exception:
-                _logger.exception('unable to delete file')
-        for rec in self.browse(cr, uid, ids, context=context):
-            if rec.source_type == 'img':
-                self._write_image_file(cr, uid, rec.id, context=context)
-            else: # 'txt'
-                self._write_html_file(cr, uid, rec.id, context=context)
+                    vals['forward_links'] = [(5, False)]
+            elif source_type == 'img' and changed:
+                source_img = vals['source_img'] if 'source_img' in vals else rec.source_img
+                if vals.get('source_img'):
+                    if rendered.get(rec.id):
+                        vals['wiki_img'] = rendered[rec.id]
+                    elif context.get('wiki_image_sync') or wiki_config('image_workers', 2) < 1:
+                        with wiki_stats.phase('write.resize'):
+                            vals['wiki_img'] = resize_image(name, source_img)
+                    else:
+                        # leave the resizing and the files to the image queue
+                        with wiki_stats.phase('write.check_image'):
+                            check_image(name, source_img)
+                        vals['img_state'] = 'pending'
+                        vals['img_queued'] = time.strftime(DEFAULT_SERVER_DATETIME_FORMAT, time.gmtime())
+                        pending.append(rec.id)
+                        source_img = None
+                        if not old_files:
+                            # stale now; the controller serves the source until they are rebuilt
+                            old_files = self._page_files(rec.wiki_key, rec.name_key, 'img')
+            if 'wiki_img' in vals and vals['wiki_img'] and source_type == 'img':
+                vals['img_state'] = 'done'
+            if 'forward_links' in vals:
+                # stubs these stop (or start) linking to
+                linked.update(f.id for f in rec.forward_links)
+                if vals['forward_links'][0][0] == 6:
+                    linked.update(vals['forward_links'][0][2])
+            with wiki_stats.phase('write.orm'):
+                if not super(wiki_doc, self).write(cr, uid, [rec.id], vals, context=context):
+                    return False
+            for old_file in old_files:
+                file_writer.delete(cr, old_file)
+            if file_doc is not None:
+                self._write_html_file(cr, wiki_key, page_key, name, file_doc)
+            elif source_img:
+                cr.execute(
+                        'SELECT source_img_digest, wiki_img_digest FROM %s WHERE id=%%s' % (self._table, ),
+                        (rec.id, ),
+                        )
+                self._write_image_file(cr, wiki_key, page_key, *cr.fetchone())
+        self._release_stubs(cr, linked)
+        with wiki_stats.phase('write.fingerprint'):
+            self._update_fingerprints(cr, ids)
+        if set(['name', 'source_doc', 'source_type']).intersection(values):
+            # from the values just written
+            with wiki_stats.phase('write.search_index'):
+                self._update_search_vector(cr, ids)
+        if moved:
+            # links to these pages from other pages may now need a different path
+            self._mark_stale(cr, moved, exclude=ids)
+        if set(['name', 'wiki_key', 'top_level', 'source_type', 'source_doc', 'source_img']).intersection(values):
+            # links, or what the link reports show, may have changed
+            self._invalidate_links(cr)
+        if pending:
+            # once committed, and the stale files are gone
+            file_writer.after_commit(cr, image_queue.notify, cr.dbname, self._name)
         return True
 
     def unlink(self, cr, uid, ids, context=None):
@@ -564,19 +3054,24 @@ class wiki_doc(osv.Model):
             if uid != SUPERUSER_ID and rec.reverse_links:
                 raise ERPError('linked document', 'cannot delete %r as other documents link to it' % rec.name)
             forward_ids.extend([f.id for f in rec.forward_links])
-            if rec.source_type == 'txt':
-                files.append(self._wiki_path/name_key(rec.wiki_key)/rec.name_key + '.html')
-            else: # image file
-                files.append(self._wiki_path/name_key(rec.wiki_key)/rec.name_key)
+            files.extend(self._page_files(rec.wiki_key, rec.name_key, rec.source_type))
+        blobs = []
+        if ids:
+            cr.execute(
+                    'SELECT source_img_digest, wiki_img_digest FROM %s WHERE id IN %%s' % (self._table, ),
+                    (tuple(ids), ),
+                    )
+            blobs = [digest for row in cr.fetchall() for digest in row if digest]
+            # their links to these are now broken
+            self._mark_stale(cr, ids, exclude=ids)
         if not super(wiki_doc, self).unlink(cr, uid, ids, context=context):
             return False
-        # records successfully deleted
+        blob_store.release(cr, blobs)
+        self._release_stubs(cr, set(forward_ids) - set(ids))
+        self._invalidate_links(cr)
+        # records successfully deleted; their files go once that is committed
         for file in files:
-            # remove files that that match deleted records
-            try:
-                file.unlink()
-            except Exception:
-                _logger.exception('unable to delete file')
+            file_writer.delete(cr, file)
         return True
 
     def onchange_wiki_key(self, cr, uid, id, wiki_key, source_doc, context=None):
@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+"""
+benchmarks for the wiki module's hot paths
+
+a synthetic wiki (pages of a given size, linked to each other and to images at a
+given density) is generated and pushed through the module, and the results are
+printed as json: for each operation its count, throughput, p50/p99 latency, and
+database queries, plus the peak RSS of the process
+
+without `--db` no database is used, and only the pure paths are measured --
+rendering (`text2html`, `html_file`), scanning for links, and resizing images
+(`resize_data`); the OpenERP server and this addon must still be importable.
+A failing pure operation is counted under `errors`, with its first exception,
+instead of ending the run
+
+with `--db` the real registry of that database is used to measure `create`,
+`write`, `_convert_links`, startup regeneration (`_regenerate_pages`), and
+`unlink`; everything is rolled back afterwards unless `--commit` is given, in
+which case the files are written, /wiki/image is requested through the server's
+WSGI application, and the pages are then deleted again
+
+    python wiki_bench.py --pages 500 --links 8 --images 0.1 > before.json
+    python wiki_bench.py -c server.conf --db test --pages 500 > before-db.json
+"""
+
+from __future__ import print_function
+
+import argparse
+import importlib
+import json
+import random
+import resource
+import sys
+import time
+from base64 import b64encode
+from contextlib import contextmanager
+from io import BytesIO
+
+WORDS = (
+        'the quick brown fox jumps over lazy dog wiki page link image render cache '
+        'server database cursor commit rollback index query document stone mark '
+        'python open source report invoice customer order product'
+        ).split()
+
+
+class Timings(object):
+    """
+    elapsed seconds and query counts of each operation
+    """
+
+    def __init__(self):
+        self.ops = {}
+        self.errors = {}
+
+    @contextmanager
+    def time(self, op, cr=None, tolerate=False):
+        """
+        time the body as one `op`; with `tolerate` an exception in it is counted
+        (and the first one kept) instead of ending the run
+        """
+        queries = getattr(cr, 'sql_log_count', None)
+        start = time.time()
+        try:
+            yield
+        except Exception as exc:
+            if not tolerate:
+                raise
+            error = self.errors.setdefault(op, {'count': 0, 'first': '%s: %s' % (type(exc).__name__, exc)})
+            error['count'] += 1
+            return
+        elapsed = time.time() - start
+        if queries is not None:
+            queries = cr.sql_log_count - queries
+        self.ops.setdefault(op, []).append((elapsed, queries))
+
+    def report(self):
+        res = {}
+        for op, samples in sorted(self.ops.items()):
+            elapsed = sorted(e for e, q in samples)
+            queries = [q for e, q in samples if q is not None]
+            total = sum(elapsed)
+            res[op] = {
+                    'count': len(elapsed),
+                    'total_s': round(total, 4),
+                    'throughput_per_s': round(len(elapsed) / total, 2) if total else None,
+                    'p50_ms': round(percentile(elapsed, 0.50) * 1000, 3),
+                    'p99_ms': round(percentile(elapsed, 0.99) * 1000, 3),
+                    }
+            if queries:
+                res[op]['queries'] = sum(queries)
+                res[op]['queries_per_op'] = round(float(sum(queries)) / len(queries), 2)
+        return res
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[int(round(fraction * (len(ordered) - 1)))]
+
+def peak_rss_kb():
+    # kilobytes on Linux, bytes on OS X
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak
+
+
+class SyntheticWiki(object):
+    """
+    deterministic pages and images
+
+    pages only link to pages and images with lower numbers, so they can be created
+    in order without any stubs being made
+    """
+
+    def __init__(self, pages, links, image_ratio, page_size, image_width, seed):
+        self.pages = pages
+        self.links = links
+        self.image_ratio = image_ratio
+        self.page_size = page_size
+        self.image_width = image_width
+        self.seed = seed
+        self.images = int(pages * image_ratio)
+
+    def page_name(self, i):
+        return 'Bench Page %05d' % i
+
+    def image_name(self, i):
+        return 'Bench Image %05d.jpg' % i
+
+    def text(self, i, revision=0):
+        rnd = random.Random('%s-%s-%s' % (self.seed, i, revision))
+        paragraphs = []
+        size = 0
+        links = self.links
+        while size < self.page_size or links > 0:
+            words = [rnd.choice(WORDS) for _ in range(rnd.randint(20, 60))]
+            if links > 0 and i > 0:
+                links -= 1
+                if self.images and rnd.random() < self.image_ratio:
+                    paragraphs.append('![%s](%s)' % ((self.image_name(rnd.randrange(self.images)), ) * 2))
+                else:
+                    target = self.page_name(rnd.randrange(i))
+                    words.insert(rnd.randrange(len(words)), '[%s]' % target)
+            elif links > 0:
+                links = 0
+            paragraph = ' '.join(words) + '.'
+            paragraph = paragraph[0].upper() + paragraph[1:]
+            paragraphs.append(paragraph)
+            size += len(paragraph)
+        return '%s\n\n%s' % (self.page_name(i), '\n\n'.join(paragraphs))
+
+    def image(self, i):
+        from PIL import Image, ImageDraw
+        rnd = random.Random('%s-img-%s' % (self.seed, i))
+        width = self.image_width
+        height = width * 2 // 3
+        image = Image.new('RGB', (width, height), (rnd.randrange(256), 128, 128))
+        draw = ImageDraw.Draw(image)
+        for _ in range(20):
+            x, y = rnd.randrange(width), rnd.randrange(height)
+            colour = tuple(rnd.randrange(256) for _ in range(3))
+            draw.rectangle([x, y, x + width // 8, y + height // 8], fill=colour)
+        data = BytesIO()
+        image.save(data, 'JPEG', quality=90)
+        return data.getvalue()
+
+
+def bench_pure(wiki, synthetic, timings):
+    "rendering and resizing only; no database"
+    rendered = []
+    for i in range(synthetic.pages):
+        name, text = synthetic.page_name(i), synthetic.text(i)
+        with timings.time('render', tolerate=True):
+            rendered.append((name, wiki.text2html(name, text)))
+    for name, document in rendered:
+        with timings.time('render_cached', tolerate=True):
+            wiki.text2html(name, synthetic.text(int(name.split()[-1])))
+    for name, document in rendered:
+        with timings.time('html_file', tolerate=True):
+            wiki.html_file(name, wiki.file_document(name, document))
+        with timings.time('link_scan', tolerate=True):
+            [mo.group(0) for mo in wiki._any_link.finditer(document)]
+    for i in range(synthetic.images):
+        data = synthetic.image(i)
+        with timings.time('resize', tolerate=True):
+            wiki.resize_data(synthetic.image_name(i), BytesIO(data), wiki.IMAGE_WIDTH)
+
+
+def bench_db(openerp, wiki, args, synthetic, timings):
+    "the ORM paths, against a real database"
+    from openerp import SUPERUSER_ID
+    from openerp.modules.registry import RegistryManager
+    registry = RegistryManager.get(args.db)
+    pages = registry[args.model]
+    uid = SUPERUSER_ID
+    key = 'Bench %d' % time.time()
+    cr = registry.db.cursor()
+    ids = []
+    try:
+        registry['wiki.key'].create(cr, uid, {'name': key})
+        for i in range(synthetic.images):
+            values = {
+                    'name': synthetic.image_name(i),
+                    'wiki_key': key,
+                    'source_type': 'img',
+                    'source_img': b64encode(synthetic.image(i)),
+                    }
+            with timings.time('create_image', cr):
+                ids.append(pages.create(cr, uid, values, context={'wiki_image_sync': True}))
+        for i in range(synthetic.pages):
+            values = {'name': synthetic.page_name(i), 'wiki_key': key, 'source_doc': synthetic.text(i)}
+            with timings.time('create', cr):
+                ids.append(pages.create(cr, uid, values))
+        page_ids = ids[synthetic.images:]
+        for i, id in enumerate(page_ids):
+            with timings.time('write', cr):
+                pages.write(cr, uid, [id], {'source_doc': synthetic.text(i, revision=1)})
+        for i, id in enumerate(page_ids):
+            document = wiki.text2html(synthetic.page_name(i), synthetic.text(i, revision=1))
+            with timings.time('convert_links', cr):
+                pages._convert_links(cr, uid, id, document, category=key)
+        cr.execute('UPDATE %s SET fingerprint=NULL WHERE wiki_key=%%s' % (pages._table, ), (key, ))
+        with timings.time('regenerate_all', cr):
+            pages._regenerate_pages(cr, key)
+        with timings.time('regenerate_none', cr):
+            pages._regenerate_pages(cr, key)
+        if args.commit:
+            cr.commit()
+            bench_controller(openerp, args, ids[:synthetic.images], timings)
+            for id in reversed(ids):
+                with timings.time('unlink', cr):
+                    pages.unlink(cr, uid, [id])
+            key_ids = registry['wiki.key'].search(cr, uid, [('name', '=', key)])
+            registry['wiki.key'].unlink(cr, uid, key_ids)
+            cr.commit()
+        else:
+            for id in reversed(ids):
+                with timings.time('unlink', cr):
+                    pages.unlink(cr, uid, [id])
+            cr.rollback()
+    finally:
+        cr.close()
+
+
+def bench_controller(openerp, args, image_ids, timings):
+    "/wiki/image through the server's WSGI application: first and conditional requests"
+    from werkzeug.test import Client
+    from werkzeug.wrappers import BaseResponse
+    client = Client(openerp.service.wsgi_server.application, BaseResponse)
+    for id in image_ids:
+        url = '/wiki/image?model=%s&img_id=%d' % (args.model, id)
+        with timings.time('image_request'):
+            response = client.get(url)
+        etag = response.headers.get('ETag')
+        if etag:
+            with timings.time('image_not_modified'):
+                client.get(url, headers=[('If-None-Match', etag)])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='benchmark the wiki module')
+    parser.add_argument('-c', '--config', help='OpenERP server configuration file')
+    parser.add_argument('--db', help='database to run the ORM benchmarks in')
+    parser.add_argument('--addon', default='wiki', help='name this addon is installed as (default: wiki)')
+    parser.add_argument('--model', default='wiki.page', help='wiki model to use (default: wiki.page)')
+    parser.add_argument('--pages', type=int, default=200, help='text pages to generate (default: 200)')
+    parser.add_argument('--links', type=int, default=5, help='links per page (default: 5)')
+    parser.add_argument('--images', type=float, default=0.1, help='images per page, and share of links to them (default: 0.1)')
+    parser.add_argument('--page-size', type=int, default=4000, help='approximate characters per page (default: 4000)')
+    parser.add_argument('--image-width', type=int, default=2400, help='width of generated images (default: 2400)')
+    parser.add_argument('--seed', default='wiki', help='seed for the generated content')
+    parser.add_argument('--commit', action='store_true', help='commit, write files, and request images (then clean up)')
+    parser.add_argument('--output', help='write the results here instead of to stdout')
+    args = parser.parse_args(argv)
+
+    import openerp
+    if args.config:
+        openerp.tools.config.parse_config(['-c', args.config])
+    wiki = importlib.import_module('openerp.addons.%s.wiki' % args.addon)
+    synthetic = SyntheticWiki(args.pages, args.links, args.images, args.page_size, args.image_width, args.seed)
+    timings = Timings()
+    start = time.time()
+    if args.db:
+        bench_db(openerp, wiki, args, synthetic, timings)
+    else:
+        bench_pure(wiki, synthetic, timings)
+    result = {
+            'mode': 'db' if args.db else 'pure',
+            'parameters': dict(
+                (name, getattr(args, name))
+                for name in ('pages', 'links', 'images', 'page_size', 'image_width', 'seed', 'model', 'commit')
+                ),
+            'renderer': wiki.renderer_version(),
+            'elapsed_s': round(time.time() - start, 3),
+            'peak_rss_kb': peak_rss_kb(),
+            'operations': timings.report(),
+            'errors': timings.errors,
+            }
+    output = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as fh:
+            fh.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()